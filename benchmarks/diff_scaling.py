@@ -0,0 +1,93 @@
+"""
+Scaling benchmark for the diff engine (runner.iter_diff over an EntityStore)
+
+Builds route shaped keys (name, service_id, ws_id) for an increasing number
+of routes, adds half of them to the EntityStore a run reads existing rows
+into and times the diff, the same one entities_to_create makes. A linear
+diff keeps the ns/route column flat as the size grows. The bytes/row column
+is the memory the store holds per row added, names included, as measured by
+tracemalloc.
+
+Usage:
+    python benchmarks/diff_scaling.py --max-routes 10000000
+"""
+import argparse
+import gc
+import os
+import sys
+import time
+import tracemalloc
+import uuid
+from typing import Iterator, List, Tuple
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from runner import EntityStore, iter_diff  # noqa: E402
+
+ROUTES_PER_SERVICE = 10
+SERVICES_PER_WORKSPACE = 500
+
+
+def route_keys(quantity: int) -> Iterator[Tuple[str, str, str]]:
+    """the same keys every time, so the store and the diff can build theirs"""
+    ws_id = svc_id = ""
+    for i in range(quantity):
+        if i % (ROUTES_PER_SERVICE * SERVICES_PER_WORKSPACE) == 0:
+            ws_id = str(uuid.uuid5(uuid.NAMESPACE_OID, "ws-{}".format(i)))
+        if i % ROUTES_PER_SERVICE == 0:
+            svc_id = str(uuid.uuid5(uuid.NAMESPACE_OID, "svc-{}".format(i)))
+        yield (
+            "perf-workspace-{}-svc-{}-route-{}".format(
+                i // (ROUTES_PER_SERVICE * SERVICES_PER_WORKSPACE),
+                (i // ROUTES_PER_SERVICE) % SERVICES_PER_WORKSPACE,
+                i % ROUTES_PER_SERVICE,
+            ),
+            svc_id,
+            ws_id,
+        )
+
+
+def run(quantity: int) -> Tuple[float, float]:
+    """the seconds the diff takes and the bytes the store holds per row"""
+    gc.collect()
+    tracemalloc.start()
+    existing = EntityStore.for_table("routes")
+    for i, (name, svc_id, ws_id) in enumerate(route_keys(quantity)):
+        if i % 2 == 0:
+            existing.add(uuid.uuid4(), name, ws_id, svc_id)
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    required: List[Tuple[str, str, str]] = list(route_keys(quantity))
+    gc.collect()
+    start = time.perf_counter()
+    create = sum(1 for _ in iter_diff(required, existing))
+    elapsed = time.perf_counter() - start
+    assert create == quantity // 2
+    return elapsed, size / len(existing)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="diff engine scaling benchmark")
+    parser.add_argument(
+        "--max-routes",
+        metavar="count",
+        type=int,
+        default=10_000_000,
+        help="the largest number of routes to diff",
+    )
+    args = parser.parse_args()
+
+    print(
+        "{:>12} {:>10} {:>10} {:>10}".format(
+            "routes", "seconds", "ns/route", "bytes/row"
+        )
+    )
+    quantity = 1000
+    while quantity <= args.max_routes:
+        elapsed, row_bytes = run(quantity)
+        print(
+            "{:>12} {:>10.3f} {:>10.1f} {:>10.0f}".format(
+                quantity, elapsed, elapsed / quantity * 1e9, row_bytes
+            )
+        )
+        quantity *= 10
@@ -0,0 +1,107 @@
+-- The tables the importer writes to, with the keys, foreign keys and indexes
+-- Kong 2.8's migrations give them. Enough to benchmark the importer against a
+-- throwaway Postgres without running Kong.
+DROP TABLE IF EXISTS plugins, routes, consumers, services, workspaces CASCADE;
+
+CREATE TABLE workspaces (
+  id uuid PRIMARY KEY,
+  name text UNIQUE,
+  comment text,
+  created_at timestamp(0) with time zone DEFAULT (CURRENT_TIMESTAMP(0) AT TIME ZONE 'UTC'),
+  meta jsonb,
+  config jsonb
+);
+
+CREATE TABLE services (
+  id uuid PRIMARY KEY,
+  created_at timestamp(0) with time zone,
+  updated_at timestamp(0) with time zone,
+  name text,
+  retries bigint,
+  protocol text,
+  host text,
+  port bigint,
+  path text,
+  connect_timeout bigint,
+  write_timeout bigint,
+  read_timeout bigint,
+  tags text[],
+  client_certificate_id uuid,
+  tls_verify boolean,
+  tls_verify_depth smallint,
+  ca_certificates uuid[],
+  ws_id uuid REFERENCES workspaces (id),
+  enabled boolean DEFAULT true,
+  UNIQUE (ws_id, name),
+  UNIQUE (id, ws_id)
+);
+CREATE INDEX services_fkey_client_certificate ON services (client_certificate_id);
+
+CREATE TABLE routes (
+  id uuid PRIMARY KEY,
+  created_at timestamp(0) with time zone,
+  updated_at timestamp(0) with time zone,
+  name text,
+  service_id uuid,
+  protocols text[],
+  methods text[],
+  hosts text[],
+  paths text[],
+  snis text[],
+  sources jsonb[],
+  destinations jsonb[],
+  regex_priority bigint,
+  strip_path boolean,
+  preserve_host boolean,
+  tags text[],
+  https_redirect_status_code integer,
+  headers jsonb,
+  path_handling text DEFAULT 'v0',
+  ws_id uuid REFERENCES workspaces (id),
+  request_buffering boolean,
+  response_buffering boolean,
+  UNIQUE (ws_id, name),
+  UNIQUE (id, ws_id),
+  FOREIGN KEY (service_id, ws_id) REFERENCES services (id, ws_id)
+);
+CREATE INDEX routes_service_id_idx ON routes (service_id);
+
+CREATE TABLE consumers (
+  id uuid PRIMARY KEY,
+  created_at timestamp(0) with time zone DEFAULT (CURRENT_TIMESTAMP(0) AT TIME ZONE 'UTC'),
+  username text,
+  custom_id text,
+  tags text[],
+  ws_id uuid REFERENCES workspaces (id),
+  username_lower text,
+  type integer NOT NULL DEFAULT 0,
+  UNIQUE (ws_id, username),
+  UNIQUE (id, ws_id)
+);
+CREATE INDEX consumers_username_lower_idx ON consumers (username_lower);
+
+CREATE TABLE plugins (
+  id uuid PRIMARY KEY,
+  created_at timestamp(0) with time zone DEFAULT (CURRENT_TIMESTAMP(0) AT TIME ZONE 'UTC'),
+  name text NOT NULL,
+  consumer_id uuid,
+  service_id uuid,
+  route_id uuid,
+  config jsonb NOT NULL,
+  enabled boolean NOT NULL,
+  cache_key text UNIQUE,
+  run_on text,
+  protocols text[],
+  tags text[],
+  ws_id uuid REFERENCES workspaces (id),
+  UNIQUE (id, ws_id),
+  FOREIGN KEY (service_id, ws_id) REFERENCES services (id, ws_id) ON DELETE CASCADE,
+  FOREIGN KEY (route_id, ws_id) REFERENCES routes (id, ws_id) ON DELETE CASCADE,
+  FOREIGN KEY (consumer_id, ws_id) REFERENCES consumers (id, ws_id) ON DELETE CASCADE
+);
+CREATE INDEX plugins_name_idx ON plugins (name);
+CREATE INDEX plugins_service_id_idx ON plugins (service_id);
+CREATE INDEX plugins_route_id_idx ON plugins (route_id);
+CREATE INDEX plugins_consumer_id_idx ON plugins (consumer_id);
+
+INSERT INTO workspaces (id, name) VALUES ('00000000-0000-0000-0000-000000000001', 'default');
@@ -0,0 +1,94 @@
+"""
+Memory check for the create path (runner.Runner with a fake database)
+
+Creates configs that only differ in their number of routes, from 10k up to
+--max-routes, each in a fresh process with the database replaced by the
+fake cursor and COPY sink of suite.py, and prints the peak resident set
+size of each. Rows are streamed and only the workspaces and services are
+kept once written, so the peak must not grow with the routes: the check
+fails, exiting with status 1, when the largest config peaks more than
+--tolerance MiB above the smallest.
+
+Usage:
+    python benchmarks/memory_scaling.py --max-routes 1000000
+"""
+import argparse
+import io
+import multiprocessing
+import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stdout
+from typing import Any, Dict, List
+
+import yaml
+
+from suite import FakeSession, runner
+
+WORKSPACES = 10
+SERVICES_PER_WORKSPACE = 100
+
+
+def config_for(routes: int) -> Dict[str, Any]:
+    """a config with the given number of routes and nothing else changing"""
+    return {
+        "workspaces": WORKSPACES,
+        "prefix": "bench",
+        "consumers_per_workspace": 10,
+        "services_per_workspace": SERVICES_PER_WORKSPACE,
+        "routes_per_service": max(routes // (WORKSPACES * SERVICES_PER_WORKSPACE), 1),
+        "plugins": {
+            "file-log": {"config": {"path": "/dev/null", "reopen": False}},
+            "cors": {"config": {"methods": ["GET"], "origins": ["*"]}},
+        },
+    }
+
+
+def create_peak(routes: int) -> int:
+    """the peak RSS, in bytes, of creating the config, in its own process"""
+    runner.Session = FakeSession
+    with tempfile.NamedTemporaryFile("w", suffix=".yaml") as f:
+        yaml.safe_dump(config_for(routes), f)
+        f.flush()
+        with redirect_stdout(io.StringIO()):
+            runner.Runner(f.name, {})
+    return runner.peak_rss()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="create path memory check")
+    parser.add_argument(
+        "--max-routes",
+        metavar="count",
+        type=int,
+        default=1_000_000,
+        help="the number of routes in the largest config, sizes grow tenfold \
+from 10000",
+    )
+    parser.add_argument(
+        "--tolerance",
+        metavar="MiB",
+        type=float,
+        default=16.0,
+        help="how much higher the largest config may peak than the smallest",
+    )
+    args = parser.parse_args()
+
+    peaks: List[int] = []
+    context = multiprocessing.get_context("spawn")
+    print("{:>12} {:>14}".format("routes", "peak rss MiB"))
+    routes = 10_000
+    while routes <= args.max_routes:
+        with ProcessPoolExecutor(1, mp_context=context) as pool:
+            peaks.append(pool.submit(create_peak, routes).result())
+        print("{:>12} {:>14.1f}".format(routes, peaks[-1] / 1024 / 1024))
+        routes *= 10
+
+    growth = (peaks[-1] - peaks[0]) / 1024 / 1024
+    if growth > args.tolerance:
+        print(
+            "peak rss grew by {:.1f} MiB with the routes, more than the {:.1f} "
+            "MiB allowed".format(growth, args.tolerance),
+            file=sys.stderr,
+        )
+        sys.exit(1)
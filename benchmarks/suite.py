@@ -0,0 +1,432 @@
+"""
+Benchmark suite for the importer (runner.Runner)
+
+Runs the importer for configs of an increasing size, from 1k routes up to
+--max-routes, and outputs rows/sec and peak memory per entity type as JSON
+so regressions can be tracked. Every case runs in a fresh process, so the
+peak memory of one case does not carry over to the next.
+
+micro: the stages that run inside the process, with the database replaced
+by a fake cursor and COPY sink. Rows are still encoded the way psycopg
+would send them, they are just never sent. Each stage is timed including
+the stages it consumes: keys (generating the required keys), hydrate
+(keys plus building the rows), encode (hydrate plus the COPY encoding),
+diff (keys plus diffing them against the entities already written) and
+create (the whole create path of the Runner).
+
+e2e: full runs against a throwaway Postgres cluster created with initdb in
+a temporary directory, listening on a unix socket only. The tables come
+from benchmarks/kong_schema.sql and are recreated for every case. Each
+case is a create run followed by a rerun that finds everything in place.
+
+Usage:
+    python benchmarks/suite.py --mode micro --max-routes 10000000
+    python benchmarks/suite.py --mode e2e --pg-bin /usr/lib/postgresql/14/bin \
+        --output bench.json
+"""
+import argparse
+import io
+import json
+import multiprocessing
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+import yaml
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager, redirect_stdout
+from itertools import repeat
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+import psycopg
+from psycopg.adapt import Transformer
+from psycopg.copy import BinaryFormatter, Formatter, TextFormatter
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARKS, ".."))
+
+import runner  # noqa: E402
+
+SCHEMA = os.path.join(BENCHMARKS, "kong_schema.sql")
+ROUTES_PER_WORKSPACE = 1000
+SERVICES_PER_WORKSPACE = 100
+CONSUMERS_PER_WORKSPACE = 10
+
+# the type of every column the importer writes, by column name
+COLUMN_TYPES: Dict[str, str] = {
+    "id": "uuid",
+    "name": "text",
+    "meta": "jsonb",
+    "retries": "int8",
+    "protocol": "text",
+    "host": "text",
+    "port": "int8",
+    "path": "text",
+    "connect_timeout": "int8",
+    "write_timeout": "int8",
+    "read_timeout": "int8",
+    "ws_id": "uuid",
+    "enabled": "bool",
+    "created_at": "timestamptz",
+    "updated_at": "timestamptz",
+    "service_id": "uuid",
+    "protocols": "text[]",
+    "paths": "text[]",
+    "regex_priority": "int8",
+    "strip_path": "bool",
+    "preserve_host": "bool",
+    "https_redirect_status_code": "int4",
+    "path_handling": "text",
+    "request_buffering": "bool",
+    "response_buffering": "bool",
+    "methods": "text[]",
+    "hosts": "text[]",
+    "config": "jsonb",
+    "cache_key": "text",
+    "username": "text",
+    "username_lower": "text",
+    "type": "int4",
+}
+
+
+def config_for(routes: int) -> Dict[str, Any]:
+    """a config with about the given number of routes"""
+    return {
+        "workspaces": max(routes // ROUTES_PER_WORKSPACE, 1),
+        "prefix": "bench",
+        "consumers_per_workspace": CONSUMERS_PER_WORKSPACE,
+        "services_per_workspace": SERVICES_PER_WORKSPACE,
+        "routes_per_service": ROUTES_PER_WORKSPACE // SERVICES_PER_WORKSPACE,
+        "plugins": {
+            "file-log": {"config": {"path": "/dev/null", "reopen": False}},
+            "cors": {"config": {"methods": ["GET"], "origins": ["*"]}},
+        },
+    }
+
+
+class FakeCopy(object):
+    """A COPY sink that encodes every row like psycopg and then drops it"""
+
+    def __init__(self, statement: Any) -> None:
+        if "FORMAT BINARY" in str(statement):
+            self.formatter: Formatter = BinaryFormatter(Transformer())
+        else:
+            self.formatter = TextFormatter(Transformer())
+
+    def __enter__(self) -> "FakeCopy":
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        self.formatter.end()
+
+    def set_types(self, types: List[int]) -> None:
+        self.formatter.transformer.set_dumper_types(types, self.formatter.format)
+
+    def write_row(self, row: Any) -> None:
+        self.formatter.write_row(row)
+
+    def rows(self) -> Iterator[Any]:
+        return iter(())
+
+
+class FakeCursor(object):
+    """A cursor over an empty database that only knows the column types"""
+
+    def __init__(self) -> None:
+        self.rowcount: int = 0
+        self.result: List[Any] = []
+
+    def __enter__(self) -> "FakeCursor":
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        pass
+
+    def execute(self, query: Any, params: Any = None) -> None:
+        self.rowcount = 0
+        self.result = []
+        if "pg_attribute" in str(query):
+            types = psycopg.adapters.types
+            self.result = [(k, types.get_oid(v)) for k, v in COLUMN_TYPES.items()]
+
+    def fetchall(self) -> List[Any]:
+        return self.result
+
+    def copy(self, statement: Any) -> FakeCopy:
+        return FakeCopy(statement)
+
+
+class FakeSession(object):
+    """Stands in for runner.Session, no connection is ever opened"""
+
+    def __init__(
+        self,
+        conninfo: str,
+        transaction: str = "entity",
+        metrics: Optional[runner.Metrics] = None,
+    ) -> None:
+        self.conninfo: str = conninfo
+        self.transaction: str = transaction
+        self.metrics: runner.Metrics = metrics or runner.Metrics()
+
+    def cursor(self) -> FakeCursor:
+        return FakeCursor()
+
+    def close(self) -> None:
+        pass
+
+    @contextmanager
+    def run(self) -> Iterator["FakeSession"]:
+        yield self
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        yield None
+
+
+class TimedRunner(runner.Runner):
+    """A Runner that records how long each entity type takes to create"""
+
+    def create_entity(self, entity: str) -> None:
+        start = time.perf_counter()
+        super().create_entity(entity)
+        vars(self).setdefault("timings", {})[entity] = time.perf_counter() - start
+
+
+def timed(work: Callable[[], int]) -> float:
+    """the rows/sec of work, which returns the number of rows it handled"""
+    start = time.perf_counter()
+    rows = work()
+    elapsed = time.perf_counter() - start
+    return rows / elapsed if elapsed else 0.0
+
+
+def consume(rows: Iterator[Any]) -> int:
+    return sum(1 for _ in rows)
+
+
+def encode(r: runner.Runner, entity: str) -> int:
+    count = 0
+    items = r.insert_items[entity]
+    with FakeCopy(r.copy_sql(entity, items)) as copy:
+        copy.set_types(r.get_column_types(entity, items))
+        for row in r.hydrate_rows(entity, zip(r.require_keys[entity](), repeat(None))):
+            copy.write_row(row)
+            count += 1
+    return count
+
+
+def written(r: runner.Runner, entity: str) -> runner.EntityStore:
+    """
+    A store of every entity of this type the run created, which the run
+    itself only keeps for CACHED_TABLES, as a rerun would read it
+    """
+    store = runner.EntityStore.for_table(entity)
+    for key in r.require_keys[entity]():
+        # keys end with the workspace, after the service for routes and plugins
+        store.add(uuid.uuid4(), key[0], *reversed(key[1:]))
+    return store
+
+
+def diff(r: runner.Runner, entity: str, existing: runner.EntityStore) -> int:
+    diffed = r.metrics.counters.get(entity, {}).get("rows_diffed", 0)
+    required = r.metrics.count(entity, "rows_diffed", r.require_keys[entity]())
+    consume(runner.iter_diff(required, existing))
+    return r.metrics.counters[entity]["rows_diffed"] - diffed
+
+
+def run_micro(config_file: str, routes: int) -> Dict[str, Any]:
+    runner.Session = FakeSession
+    with redirect_stdout(io.StringIO()):
+        r = TimedRunner(config_file, {}, memory_report=True)
+    entities: Dict[str, Any] = {}
+    for entity in r.entites:
+        rows = r.created[entity]
+        keys = r.require_keys[entity]
+        existing = written(r, entity)
+        stages = {
+            "create": rows / r.timings[entity],
+            "keys": timed(lambda: consume(keys())),
+            "hydrate": timed(
+                lambda: consume(r.hydrate_rows(entity, zip(keys(), repeat(None))))
+            ),
+            "encode": timed(lambda: encode(r, entity)),
+            "diff": timed(lambda: diff(r, entity, existing)),
+        }
+        entities[entity] = {
+            "rows": rows,
+            "peak_rss_bytes": r.memory_usage[entity],
+            "rows_per_sec": {k: round(v) for k, v in stages.items()},
+        }
+    return {"mode": "micro", "routes": routes, "entities": entities}
+
+
+def run_e2e(config_file: str, routes: int, params: Dict[str, str]) -> Dict[str, Any]:
+    with psycopg.connect(conninfo(params), autocommit=True) as conn:
+        with open(SCHEMA) as f:
+            conn.execute(f.read())
+    entities: Dict[str, Any] = {}
+    with redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        r = TimedRunner(config_file, params, memory_report=True)
+        create = time.perf_counter() - start
+        start = time.perf_counter()
+        rerun = TimedRunner(config_file, params)
+        rerun_elapsed = time.perf_counter() - start
+    for entity in r.entites:
+        rows = r.created[entity]
+        entities[entity] = {
+            "rows": rows,
+            "seconds": round(r.timings[entity], 3),
+            "rows_per_sec": round(rows / r.timings[entity]),
+            "rerun_seconds": round(rerun.timings[entity], 3),
+            "peak_rss_bytes": r.memory_usage[entity],
+        }
+    rows = sum(r.created.values())
+    return {
+        "mode": "e2e",
+        "routes": routes,
+        "rows": rows,
+        "seconds": round(create, 3),
+        "rows_per_sec": round(rows / create),
+        "rerun_seconds": round(rerun_elapsed, 3),
+        "entities": entities,
+    }
+
+
+def run_case(mode: str, routes: int, params: Dict[str, str]) -> Dict[str, Any]:
+    """run one case, in its own process"""
+    with tempfile.NamedTemporaryFile("w", suffix=".yaml") as f:
+        yaml.safe_dump(config_for(routes), f)
+        f.flush()
+        if mode == "micro":
+            return run_micro(f.name, routes)
+        return run_e2e(f.name, routes, params)
+
+
+def conninfo(params: Dict[str, str]) -> str:
+    return "host={hostname} dbname={database} user={username}".format(**params)
+
+
+def find_pg_bin(pg_bin: Optional[str]) -> str:
+    if pg_bin:
+        return pg_bin
+    initdb = shutil.which("initdb")
+    if initdb:
+        return os.path.dirname(initdb)
+    try:
+        return subprocess.run(
+            ["pg_config", "--bindir"], check=True, capture_output=True, text=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        raise SystemExit("initdb not found, pass the directory it is in with --pg-bin")
+
+
+@contextmanager
+def local_postgres(pg_bin: str) -> Iterator[Dict[str, str]]:
+    """
+    Start a throwaway Postgres cluster in a temporary directory, reachable
+    only over a unix socket in that directory, and remove it afterwards
+    """
+    root = tempfile.mkdtemp(prefix="kong-bench-")
+    data = os.path.join(root, "data")
+    pg_ctl = os.path.join(pg_bin, "pg_ctl")
+    subprocess.run(
+        [os.path.join(pg_bin, "initdb"), "-D", data, "-U", "kong", "--auth=trust"],
+        check=True,
+        stdout=subprocess.DEVNULL,
+    )
+    subprocess.run(
+        [
+            pg_ctl,
+            "-D",
+            data,
+            "-l",
+            os.path.join(root, "postgres.log"),
+            "-o",
+            "-c listen_addresses='' -k {}".format(root),
+            "-w",
+            "start",
+        ],
+        check=True,
+        stdout=subprocess.DEVNULL,
+    )
+    try:
+        params = {"hostname": root, "database": "postgres", "username": "kong"}
+        with psycopg.connect(conninfo(params), autocommit=True) as conn:
+            conn.execute("CREATE DATABASE kong;")
+        yield dict(params, database="kong", password="kong")
+    finally:
+        subprocess.run(
+            [pg_ctl, "-D", data, "-m", "fast", "stop"],
+            stdout=subprocess.DEVNULL,
+        )
+        shutil.rmtree(root, ignore_errors=True)
+
+
+def run_cases(
+    mode: str, sizes: List[int], params: Dict[str, str]
+) -> List[Dict[str, Any]]:
+    results = []
+    context = multiprocessing.get_context("spawn")
+    for routes in sizes:
+        print("{} {} routes".format(mode, routes), file=sys.stderr)
+        with ProcessPoolExecutor(1, mp_context=context) as pool:
+            results.append(pool.submit(run_case, mode, routes, params).result())
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="importer benchmark suite")
+    parser.add_argument(
+        "--mode",
+        choices=["micro", "e2e", "all"],
+        default="micro",
+        help="which benchmarks to run",
+    )
+    parser.add_argument(
+        "--max-routes",
+        metavar="count",
+        type=int,
+        default=10_000_000,
+        help="the number of routes in the largest config, sizes grow tenfold \
+from 1000",
+    )
+    parser.add_argument(
+        "--pg-bin",
+        metavar="path",
+        help="the directory holding initdb and pg_ctl for the e2e benchmarks",
+    )
+    parser.add_argument(
+        "--output",
+        metavar="path",
+        help="write the results to this file instead of stdout",
+    )
+    args = parser.parse_args()
+
+    sizes = []
+    routes = 1000
+    while routes <= args.max_routes:
+        sizes.append(routes)
+        routes *= 10
+
+    results: List[Dict[str, Any]] = []
+    if args.mode in ("micro", "all"):
+        results += run_cases("micro", sizes, {})
+    if args.mode in ("e2e", "all"):
+        with local_postgres(find_pg_bin(args.pg_bin)) as params:
+            results += run_cases("e2e", sizes, params)
+
+    report = {
+        "python": sys.version.split()[0],
+        "psycopg": psycopg.__version__,
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
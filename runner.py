@@ -1,10 +1,953 @@
+import asyncio
+import csv
+import gzip
+import hashlib
 import psycopg
+from psycopg import sql
+from psycopg.conninfo import conninfo_to_dict
+from psycopg.types.json import Jsonb
 import json
+import math
+import os
+import re
+import resource
+import sys
+import time
 import uuid
 import yaml
-import re
-from typing import Dict, List, Any
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+from itertools import cycle, islice, repeat
+from typing import (
+    IO,
+    Any,
+    Dict,
+    Hashable,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+)
 from datetime import datetime, timezone
+from decimal import Decimal
+
+
+def iter_diff(
+    required: Iterable[Tuple[str, ...]],
+    existing: "EntityStore",
+) -> Iterator[Tuple[str, ...]]:
+    """
+    Lazily yield the required keys that are missing from existing. Nothing
+    is held for the keys, whether they exist or not, so required can be a
+    generator of any size.
+    """
+    for key in required:
+        if existing.get(key) is None:
+            yield key
+
+
+ID_NAMESPACE: uuid.UUID = uuid.uuid5(uuid.NAMESPACE_DNS, "kong-postgres-importer")
+
+# the seconds spent hydrating the rows of the Metrics.stream being consumed,
+# kept per context so that the streams of concurrent asyncio tasks, each
+# running in a context of its own, do not count each other's
+STREAM_HYDRATE: ContextVar = ContextVar("stream_hydrate", default=None)
+
+
+def peak_rss() -> int:
+    """the peak resident set size of this process in bytes"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def deterministic_id(entity: str, name: str) -> uuid.UUID:
+    """
+    The UUIDv5 id of an entity. The names generated for each entity embed
+    the prefix, the workspace index and the entity's ordinal, so the same
+    config always produces the same ids.
+    """
+    return uuid.uuid5(ID_NAMESPACE, "{}:{}".format(entity, name))
+
+
+def write_paths(f: IO[str], paths: Iterable[str], format_: str = "json") -> int:
+    """
+    Write paths to f one at a time, as a JSON array, as NDJSON (a JSON
+    string per line) or as CSV with a path header, returning how many
+    """
+    count = 0
+    if format_ == "csv":
+        writer = csv.writer(f, lineterminator="\n")
+        writer.writerow(["path"])
+        for path in paths:
+            writer.writerow([path])
+            count += 1
+    elif format_ == "ndjson":
+        for path in paths:
+            f.write(json.dumps(path) + "\n")
+            count += 1
+    else:
+        f.write("[")
+        for path in paths:
+            f.write((",\n" if count else "\n") + json.dumps(path))
+            count += 1
+        f.write("\n]\n")
+    return count
+
+
+def uuid_text(value: bytes) -> str:
+    """the text form of a UUID held as 16 bytes"""
+    h = value.hex()
+    return "{}-{}-{}-{}-{}".format(h[:8], h[8:12], h[12:16], h[16:20], h[20:])
+
+
+def random_ids(batch: int = 4096) -> Iterator[uuid.UUID]:
+    """
+    Yield random (version 4) UUIDs like uuid.uuid4, reading the random bytes
+    for a batch of them at a time and setting the version and variant bits
+    on the integer, instead of a system call and a bytes parse per id
+    """
+    clear = ~(0xF000 << 64 | 0xC000 << 48)
+    version = 0x4000 << 64 | 0x8000 << 48
+    from_bytes = int.from_bytes
+    UUID = uuid.UUID
+    while True:
+        data = os.urandom(16 * batch)
+        for i in range(0, 16 * batch, 16):
+            yield UUID(int=from_bytes(data[i : i + 16], "big") & clear | version)
+
+
+class EntityRecord(object):
+    """A view of one row of an EntityStore, its values read when asked for"""
+
+    __slots__ = ("store", "row", "name")
+
+    def __init__(self, store: "EntityStore", row: int, name: str) -> None:
+        self.store: EntityStore = store
+        self.row: int = row
+        self.name: str = name
+
+    @property
+    def id(self) -> str:
+        return self.store.id(self.row)
+
+    @property
+    def ws_id(self) -> Optional[str]:
+        return self.store.ws_id(self.row)
+
+    @property
+    def parent_id(self) -> Optional[str]:
+        return self.store.parent_id(self.row)
+
+    @property
+    def key(self) -> Tuple[str, ...]:
+        return self.store.key(self.row, self.name)
+
+
+class EntityStore(object):
+    """
+    The rows of one table that a run knows about, held compactly so that
+    millions of them fit in memory. Ids are kept as 16 byte UUIDs in one
+    bytearray, the workspace and parent (the service of a route or plugin)
+    of each row as indexes, in arrays, into lists of the distinct ids, and
+    names in one dict per workspace mapping them to their row.
+
+    Rows are looked up by key, the tuple the *_require_keys functions
+    yield: (name,) for workspaces, (name, ws_id) for services and consumers
+    and (name, service_id, ws_id) for routes and plugins. get makes the store
+    usable as the mapping of keys to ids that iter_diff expects, and records
+    iterates it by workspace and by parent, the rows of each parent being
+    indexed by workspace in children.
+
+    Attributes
+    ----------
+    workspaced : bool
+        whether rows belong to a workspace, everything but workspaces
+    parented : bool
+        whether rows belong to a service, routes and plugins
+    unique_names : bool
+        whether names are unique within a workspace. Plugin names are not,
+        so plugins are indexed by name and parent and their names are
+        interned, each distinct name being held once.
+    """
+
+    __slots__ = (
+        "workspaced",
+        "parented",
+        "unique_names",
+        "ids",
+        "workspaces",
+        "parents",
+        "ws_ids",
+        "ws_index",
+        "parent_ids",
+        "parent_index",
+        "index",
+        "children",
+        "names",
+    )
+
+    def __init__(
+        self, workspaced: bool = True, parented: bool = False, unique_names=True
+    ) -> None:
+        self.workspaced: bool = workspaced
+        self.parented: bool = parented
+        self.unique_names: bool = unique_names
+        self.ids: bytearray = bytearray()
+        self.workspaces: array = array("I")
+        self.parents: array = array("I")
+        self.ws_ids: List[str] = []
+        self.ws_index: Dict[str, int] = {}
+        self.parent_ids: List[str] = []
+        self.parent_index: Dict[str, int] = {}
+        self.index: Dict[int, Dict[Hashable, int]] = {}
+        self.children: Dict[int, Dict[int, List[Hashable]]] = {}
+        self.names: Dict[str, str] = {}
+
+    @classmethod
+    def for_table(cls, table: str) -> "EntityStore":
+        return cls(
+            workspaced=table != "workspaces",
+            parented=table in ("routes", "plugins"),
+            unique_names=table != "plugins",
+        )
+
+    def __len__(self) -> int:
+        return len(self.ids) // 16
+
+    @staticmethod
+    def slot(values: List[str], index: Dict[str, int], value: Any) -> int:
+        """the position of value in values, appending it the first time"""
+        value = str(value)
+        position = index.get(value)
+        if position is None:
+            position = index[value] = len(values)
+            values.append(value)
+        return position
+
+    def add(
+        self, id_: Any, name: str, ws_id: Any = None, parent_id: Any = None
+    ) -> None:
+        """
+        Add a row. id_ can be a UUID, its 16 bytes or its text, ws_id and
+        parent_id a UUID or its text.
+        """
+        row = len(self)
+        if isinstance(id_, uuid.UUID):
+            self.ids += id_.bytes
+        elif isinstance(id_, str):
+            self.ids += bytes.fromhex(id_.replace("-", ""))
+        else:
+            self.ids += id_
+        ws = 0
+        if self.workspaced:
+            ws = self.slot(self.ws_ids, self.ws_index, ws_id)
+            self.workspaces.append(ws)
+        local: Hashable = name
+        group = self.index.get(ws)
+        if group is None:
+            group = self.index[ws] = {}
+        if self.parented:
+            parent = self.slot(self.parent_ids, self.parent_index, parent_id)
+            self.parents.append(parent)
+            if not self.unique_names:
+                local = (self.names.setdefault(name, name), parent)
+            previous = group.get(local)
+            if previous is None or self.parents[previous] != parent:
+                if previous is not None:
+                    # a row added again under another parent moves to it
+                    self.children[self.parents[previous]][ws].remove(local)
+                self.children.setdefault(parent, {}).setdefault(ws, []).append(local)
+        group[local] = row
+
+    def update(self, other: "EntityStore") -> None:
+        """add the rows of another store of the same table"""
+        for record in other.records():
+            self.add(
+                other.ids[16 * record.row : 16 * record.row + 16],
+                record.name,
+                record.ws_id,
+                record.parent_id,
+            )
+
+    def id(self, row: int) -> str:
+        return uuid_text(self.ids[16 * row : 16 * row + 16])
+
+    def ws_id(self, row: int) -> Optional[str]:
+        return self.ws_ids[self.workspaces[row]] if self.workspaced else None
+
+    def parent_id(self, row: int) -> Optional[str]:
+        return self.parent_ids[self.parents[row]] if self.parented else None
+
+    def key(self, row: int, name: str) -> Tuple[str, ...]:
+        if not self.workspaced:
+            return (name,)
+        if self.parented:
+            return (name, self.parent_id(row), self.ws_id(row))
+        return (name, self.ws_id(row))
+
+    def get(self, key: Tuple[str, ...], default: Optional[str] = None) -> Optional[str]:
+        """the id of the row with this key"""
+        group = self.index.get(self.ws_index.get(key[-1], -1) if self.workspaced else 0)
+        if group is None:
+            return default
+        if self.parented:
+            parent = self.parent_index.get(key[1])
+            if parent is None:
+                return default
+            row = group.get(key[0] if self.unique_names else (key[0], parent))
+            if row is None or self.parents[row] != parent:
+                return default
+        else:
+            row = group.get(key[0])
+            if row is None:
+                return default
+        return self.id(row)
+
+    def records(
+        self, ws_id: Optional[str] = None, parent_id: Optional[str] = None
+    ) -> Iterator[EntityRecord]:
+        """every row, or the rows of one workspace and/or one parent"""
+        if parent_id is not None:
+            yield from self.children_records(ws_id, parent_id)
+            return
+        if ws_id is None:
+            groups: Iterable[Dict[Hashable, int]] = self.index.values()
+        else:
+            groups = [self.index.get(self.ws_index.get(ws_id, -1), {})]
+        for group in groups:
+            for local, row in group.items():
+                yield EntityRecord(self, row, local if self.unique_names else local[0])
+
+    def children_records(
+        self, ws_id: Optional[str], parent_id: str
+    ) -> Iterator[EntityRecord]:
+        """the rows of one parent, looked up in children"""
+        parent = self.parent_index.get(parent_id, -1)
+        by_workspace = self.children.get(parent, {})
+        if ws_id is None:
+            workspaces: Iterable[int] = by_workspace
+        else:
+            workspaces = [self.ws_index.get(ws_id, -1)]
+        for ws in workspaces:
+            group = self.index.get(ws, {})
+            for local in by_workspace.get(ws, ()):
+                yield EntityRecord(
+                    self, group[local], local if self.unique_names else local[0]
+                )
+
+
+class Metrics(object):
+    """
+    Timings and counters for each phase of a run, per entity type
+
+    Phases: read (reading existing rows), diff (generating the required keys
+    and finding the missing ones), hydrate (building rows), copy (sending
+    them), generate (set based inserts), delete, churn (updates in place),
+    index and analyze. The
+    seconds of a phase are summed over every time it ran, so with workers or
+    the async engine they can add up to more than the wall time of the run.
+
+    Attributes
+    ----------
+    phases : dict
+        the seconds spent in each phase, by entity type
+    counters : dict
+        the rows read, diffed, written, updated and deleted and the bytes
+        sent, by entity type
+    peak_rss : dict
+        the peak resident set size once each entity type was done
+    connect_seconds : float
+        the time spent opening database connections
+    """
+
+    COUNTERS: Tuple[str, ...] = (
+        "rows_read",
+        "rows_diffed",
+        "rows_written",
+        "rows_updated",
+        "rows_deleted",
+        "bytes_sent",
+    )
+    FORMATS: Tuple[str, ...] = ("json", "prometheus")
+
+    def __init__(self) -> None:
+        self.phases: Dict[str, Dict[str, float]] = {}
+        self.counters: Dict[str, Dict[str, int]] = {}
+        self.peak_rss: Dict[str, int] = {}
+        self.connect_seconds: float = 0.0
+        self.connections: int = 0
+        self.started: float = time.perf_counter()
+        self.elapsed: float = 0.0
+
+    def add_time(self, entity: str, phase: str, seconds: float) -> None:
+        phases = self.phases.setdefault(entity, {})
+        phases[phase] = phases.get(phase, 0.0) + seconds
+
+    def add(self, entity: str, counter: str, value: int) -> None:
+        counters = self.counters.setdefault(entity, dict.fromkeys(self.COUNTERS, 0))
+        counters[counter] += value
+
+    def seconds(self, entity: str, phase: str) -> float:
+        return self.phases.get(entity, {}).get(phase, 0.0)
+
+    @contextmanager
+    def phase(self, entity: str, phase: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(entity, phase, time.perf_counter() - start)
+
+    def count(self, entity: str, counter: str, items: Iterable[Any]) -> Iterator[Any]:
+        """yield items, adding how many there were to counter"""
+        count = 0
+        for item in items:
+            count += 1
+            yield item
+        self.add(entity, counter, count)
+
+    def stream(
+        self, entity: str, rows: Iterable[Any], progress: bool = True
+    ) -> Iterator[Any]:
+        """
+        Yield rows to a writer, timing how long the lazy pipeline takes to
+        produce each one (the diff, minus the time hydrate_rows spent on this
+        stream's rows, see STREAM_HYDRATE) and how long the writer takes with
+        it (copy). Prints a progress line at most twice a second when
+        progress is set.
+        """
+        hydrated: List[float] = [0.0]
+        token = STREAM_HYDRATE.set(hydrated)
+        produce = consume = 0.0
+        count = 0
+        start = last = time.perf_counter()
+        for row in rows:
+            yielded = time.perf_counter()
+            produce += yielded - start
+            yield row
+            start = time.perf_counter()
+            consume += start - yielded
+            count += 1
+            if progress and start - last > 0.5:
+                last = start
+                print(
+                    "{} creating: {} ({:.0f} rows/sec)".format(
+                        entity, count, count / (produce + consume)
+                    ),
+                    end="\r",
+                )
+        produce += time.perf_counter() - start
+        STREAM_HYDRATE.reset(token)
+        self.add_time(entity, "diff", produce - hydrated[0])
+        self.add_time(entity, "copy", consume)
+        self.add(entity, "rows_written", count)
+
+    def watch_copy(self, entity: str, copy: Any) -> None:
+        """
+        Count the bytes a COPY sends for entity, by wrapping the formatter
+        that turns its rows into the data handed to libpq
+        """
+        formatter = copy.formatter
+        write_row, end = formatter.write_row, formatter.end
+
+        def sent(data: bytes) -> bytes:
+            if data:
+                self.add(entity, "bytes_sent", len(data))
+            return data
+
+        formatter.write_row = lambda row: sent(write_row(row))
+        formatter.end = lambda: sent(end())
+
+    def record_rss(self, entity: str) -> None:
+        self.peak_rss[entity] = peak_rss()
+
+    def merge(self, other: "Metrics") -> None:
+        """add the metrics of a worker to these"""
+        for entity, phases in other.phases.items():
+            for phase, seconds in phases.items():
+                self.add_time(entity, phase, seconds)
+        for entity, counters in other.counters.items():
+            for counter, value in counters.items():
+                self.add(entity, counter, value)
+        for entity, peak in other.peak_rss.items():
+            self.peak_rss[entity] = max(self.peak_rss.get(entity, 0), peak)
+        self.connect_seconds += other.connect_seconds
+        self.connections += other.connections
+
+    def finish(self) -> None:
+        self.elapsed = time.perf_counter() - self.started
+
+    def rows_per_sec(self, entity: str) -> float:
+        counters = self.counters.get(entity, {})
+        rows = sum(
+            counters.get(c, 0) for c in ("rows_written", "rows_updated", "rows_deleted")
+        )
+        seconds = sum(self.phases.get(entity, {}).values())
+        return rows / seconds if seconds else 0.0
+
+    def entities(self) -> List[str]:
+        return list(dict.fromkeys(list(self.phases) + list(self.counters)))
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "seconds": round(self.elapsed, 3),
+            "connect_seconds": round(self.connect_seconds, 3),
+            "connections": self.connections,
+            "peak_rss_bytes": max(self.peak_rss.values(), default=peak_rss()),
+            "entities": {
+                entity: {
+                    "phases": {
+                        k: round(v, 3) for k, v in self.phases.get(entity, {}).items()
+                    },
+                    **self.counters.get(entity, dict.fromkeys(self.COUNTERS, 0)),
+                    "rows_per_sec": round(self.rows_per_sec(entity)),
+                    "peak_rss_bytes": self.peak_rss.get(entity, 0),
+                }
+                for entity in self.entities()
+            },
+        }
+
+    def to_prometheus(self) -> str:
+        """the metrics in the Prometheus text exposition format"""
+        lines: List[str] = []
+
+        def metric(name: str, help_: str, samples: List[Tuple[str, Any]]) -> None:
+            lines.append("# HELP kong_importer_{} {}".format(name, help_))
+            lines.append("# TYPE kong_importer_{} gauge".format(name))
+            for labels, value in samples:
+                lines.append("kong_importer_{}{} {}".format(name, labels, value))
+
+        entities = self.entities()
+        metric("run_seconds", "Wall time of the run", [("", round(self.elapsed, 3))])
+        metric(
+            "connect_seconds",
+            "Time spent opening database connections",
+            [("", round(self.connect_seconds, 3))],
+        )
+        metric(
+            "phase_seconds",
+            "Time spent in each phase, per entity type",
+            [
+                ('{{entity="{}",phase="{}"}}'.format(entity, phase), round(seconds, 3))
+                for entity in entities
+                for phase, seconds in self.phases.get(entity, {}).items()
+            ],
+        )
+        for counter in self.COUNTERS:
+            metric(
+                counter,
+                "The {} of each entity type".format(counter.replace("_", " ")),
+                [
+                    ('{{entity="{}"}}'.format(entity), value)
+                    for entity in entities
+                    for value in [self.counters.get(entity, {}).get(counter, 0)]
+                ],
+            )
+        metric(
+            "rows_per_second",
+            "Rows written, updated or deleted per second of phase time, per "
+            "entity type",
+            [
+                ('{{entity="{}"}}'.format(entity), round(self.rows_per_sec(entity)))
+                for entity in entities
+            ],
+        )
+        metric(
+            "peak_rss_bytes",
+            "Peak resident set size once each entity type was done",
+            [
+                ('{{entity="{}"}}'.format(entity), peak)
+                for entity, peak in self.peak_rss.items()
+            ],
+        )
+        return "\n".join(lines) + "\n"
+
+    def write(self, path: str, format_: str = "json") -> None:
+        if format_ not in self.FORMATS:
+            raise ValueError(
+                "unknown metrics format {}, expected one of {}".format(
+                    format_, ", ".join(self.FORMATS)
+                )
+            )
+        with open(path, "w") as f:
+            if format_ == "prometheus":
+                f.write(self.to_prometheus())
+            else:
+                json.dump(self.to_dict(), f, indent=2)
+
+    def summary(self) -> List[str]:
+        """a line per entity type describing where its time went"""
+        lines = []
+        for entity in self.entities():
+            counters = self.counters.get(entity, dict.fromkeys(self.COUNTERS, 0))
+            lines.append(
+                "{}: {} | read {} written {} updated {} deleted {} | "
+                "{:.1f} MiB sent | {:.0f} rows/sec | peak rss {:.1f} MiB".format(
+                    entity,
+                    " ".join(
+                        "{} {:.2f}s".format(k, v)
+                        for k, v in self.phases.get(entity, {}).items()
+                    ),
+                    counters["rows_read"],
+                    counters["rows_written"],
+                    counters["rows_updated"],
+                    counters["rows_deleted"],
+                    counters["bytes_sent"] / 1024 / 1024,
+                    self.rows_per_sec(entity),
+                    self.peak_rss.get(entity, 0) / 1024 / 1024,
+                )
+            )
+        return lines
+
+
+class Archive(object):
+    """
+    A directory of COPY files, one or more per table, and the manifest that
+    describes them, written by an export and loaded back by an import
+
+    Attributes
+    ----------
+    path : str
+        the directory the files are in
+    compression : str
+        how the files are compressed, one of COMPRESSIONS. zstd needs the
+        zstandard package.
+    """
+
+    COMPRESSIONS: Tuple[str, ...] = ("none", "gzip", "zstd")
+    EXTENSIONS: Dict[str, str] = {"none": "", "gzip": ".gz", "zstd": ".zst"}
+    MANIFEST: str = "manifest.json"
+    VERSION: int = 1
+
+    def __init__(self, path: str, compression: str = "none") -> None:
+        self.path: str = path
+        self.compression: str = "none"
+        self.set_compression(compression)
+
+    def set_compression(self, compression: str) -> None:
+        if compression not in self.COMPRESSIONS:
+            raise ValueError(
+                "unknown compression {}, expected one of {}".format(
+                    compression, ", ".join(self.COMPRESSIONS)
+                )
+            )
+        if compression == "zstd":
+            self.zstandard()
+        self.compression = compression
+
+    @staticmethod
+    def zstandard() -> Any:
+        try:
+            import zstandard
+        except ImportError:
+            raise ValueError(
+                "zstd compression needs the zstandard package "
+                "(pip install zstandard)"
+            )
+        return zstandard
+
+    def file_name(self, table: str, part: int) -> str:
+        return "{}.{}.copy{}".format(table, part, self.EXTENSIONS[self.compression])
+
+    def open(self, name: str, mode: str) -> IO[bytes]:
+        """open one of the files for reading (r) or writing (w) as bytes"""
+        path = os.path.join(self.path, name)
+        if self.compression == "gzip":
+            return gzip.open(path, mode + "b", compresslevel=6)
+        if self.compression == "zstd":
+            return self.zstandard().open(path, mode + "b")
+        return open(path, mode + "b")
+
+    def write_manifest(self, manifest: Dict[str, Any]) -> None:
+        manifest = dict(manifest, version=self.VERSION, compression=self.compression)
+        with open(os.path.join(self.path, self.MANIFEST), "w") as f:
+            json.dump(manifest, f, indent=2)
+
+    def read_manifest(self) -> Dict[str, Any]:
+        """read the manifest and switch to the compression it was written with"""
+        with open(os.path.join(self.path, self.MANIFEST)) as f:
+            manifest: Dict[str, Any] = json.load(f)
+        if manifest.get("version") != self.VERSION:
+            raise ValueError(
+                "{} is not an export this version can import".format(self.path)
+            )
+        self.set_compression(manifest["compression"])
+        return manifest
+
+
+class Journal(object):
+    """
+    A local checkpoint file for a run that commits in chunks. Its first line
+    identifies the config the run was started with, then a line is added
+    for every workspace once all of its entities of a type are committed. A
+    resumed run skips whatever the journal records as done, without reading
+    or diffing it again.
+
+    Attributes
+    ----------
+    path : str
+        where the journal is kept
+    done : set
+        the (entity type, workspace name) pairs that are fully written
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path: str = path
+        self.done: Set[Tuple[str, str]] = set()
+        self.file: Optional[IO[str]] = None
+
+    def open(self, config: Dict[str, Any], resume: bool) -> None:
+        """
+        Start a new journal for config or, with resume, load the one left by
+        an earlier run of the same config and carry on appending to it
+        """
+        entries: List[Dict[str, Any]] = []
+        if resume and os.path.exists(self.path):
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        entries.append(json.loads(line))
+                    except ValueError:
+                        # the last line of a run that was killed while
+                        # writing it, that workspace is simply not done
+                        break
+            if not entries or entries[0] != {"config": config}:
+                raise ValueError(
+                    "the journal {} was written for a different config".format(
+                        self.path
+                    )
+                )
+            self.done = {(e["entity"], e["workspace"]) for e in entries[1:]}
+        elif resume:
+            print("no journal at {}, starting from the beginning".format(self.path))
+        # rewritten whole, so a torn last line is not appended to
+        self.file = open(self.path, "w")
+        for entry in entries or [{"config": config}]:
+            self.write(entry)
+
+    def write(self, entry: Dict[str, Any]) -> None:
+        self.file.write(json.dumps(entry) + "\n")
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def is_done(self, entity: str, workspace: str) -> bool:
+        return (entity, workspace) in self.done
+
+    def record(self, entity: str, workspace: str) -> None:
+        self.done.add((entity, workspace))
+        self.write({"entity": entity, "workspace": workspace})
+
+    def close(self) -> None:
+        if self.file is not None:
+            self.file.close()
+        self.file = None
+
+
+class Session(object):
+    """
+    The database session shared by every read and write of a run. A single
+    connection is opened on first use and reused until the run ends, so
+    connection setup and authentication are only paid once.
+
+    Attributes
+    ----------
+    conninfo : str
+        the libpq connection string for the Kong database
+    transaction : str
+        how the stages of a run (one per entity type) are committed.
+        entity: each stage commits on its own (the default).
+        single: the whole run is one transaction, a failure leaves the
+        database untouched.
+        savepoint: the whole run is one transaction with a savepoint per
+        stage, a failed stage is rolled back to its savepoint, the stages
+        before it are committed and the run stops.
+    metrics : Metrics
+        where the time spent connecting is recorded
+    """
+
+    TRANSACTION_MODES: Tuple[str, ...] = ("entity", "single", "savepoint")
+
+    def __init__(
+        self,
+        conninfo: str,
+        transaction: str = "entity",
+        metrics: Optional[Metrics] = None,
+    ) -> None:
+        if transaction not in self.TRANSACTION_MODES:
+            raise ValueError(
+                "unknown transaction mode {}, expected one of {}".format(
+                    transaction, ", ".join(self.TRANSACTION_MODES)
+                )
+            )
+        self.conninfo: str = conninfo
+        self.transaction: str = transaction
+        self.metrics: Metrics = metrics or Metrics()
+        self.conn: Optional[psycopg.Connection] = None
+
+    def connection(self) -> psycopg.Connection:
+        if self.conn is None or self.conn.closed:
+            start = time.perf_counter()
+            self.conn = psycopg.connect(self.conninfo, autocommit=True)
+            self.metrics.connect_seconds += time.perf_counter() - start
+            self.metrics.connections += 1
+        return self.conn
+
+    def cursor(self) -> psycopg.Cursor:
+        return self.connection().cursor()
+
+    def close(self) -> None:
+        if self.conn is not None and not self.conn.closed:
+            self.conn.close()
+        self.conn = None
+
+    @contextmanager
+    def run(self) -> Iterator["Session"]:
+        """wrap a whole run, opening the outer transaction if the mode needs one"""
+        try:
+            if self.transaction == "entity":
+                yield self
+                return
+            error: Optional[Exception] = None
+            with self.connection().transaction():
+                try:
+                    yield self
+                except Exception as exc:
+                    if self.transaction != "savepoint":
+                        raise
+                    error = exc
+            if error is not None:
+                raise error
+        finally:
+            self.close()
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[psycopg.Connection]:
+        """wrap the work done for one entity type"""
+        conn = self.connection()
+        if self.transaction == "single":
+            yield conn
+        elif self.transaction == "savepoint":
+            with conn.transaction(savepoint_name=name):
+                yield conn
+        else:
+            with conn.transaction():
+                yield conn
+
+
+class BatchSizer(object):
+    """
+    Sizes the batches an entity type is written in, each one a COPY in a
+    transaction of its own. With a target commit time, the rows/sec of the
+    batches so far (smoothed, so one slow commit does not swing it) set the
+    next batch to the rows expected to fit in the target, at most doubling
+    or halving it at a time. Batches grow while the server keeps up and
+    shrink as soon as commits slow down, which bounds how long locks are
+    held and how much WAL one commit flushes. Without a target every batch
+    has the starting size.
+
+    Attributes
+    ----------
+    size : int
+        the rows in the next batch
+    target_ms : float
+        the milliseconds a batch should take from its first row to its
+        commit, 0 to keep the size fixed
+    rate : float
+        the smoothed rows/sec of the batches so far
+    """
+
+    MIN_ROWS: int = 100
+    MAX_ROWS: int = 1000000
+    # the weight of the latest batch in the smoothed rows/sec
+    SMOOTHING: float = 0.5
+
+    def __init__(self, size: int, target_ms: float = 0.0) -> None:
+        self.size: int = size
+        self.target_ms: float = target_ms
+        self.rate: Optional[float] = None
+
+    def update(self, rows: int, seconds: float) -> int:
+        """record a batch of rows that took seconds, returning the next size"""
+        if self.target_ms and rows and seconds > 0:
+            rate = rows / seconds
+            if self.rate is not None:
+                rate = self.SMOOTHING * rate + (1 - self.SMOOTHING) * self.rate
+            self.rate = rate
+            ideal = rate * self.target_ms / 1000
+            size = min(max(ideal, self.size / 2), self.size * 2)
+            self.size = int(min(max(size, self.MIN_ROWS), self.MAX_ROWS))
+        return self.size
+
+
+class Target(object):
+    """
+    One of the databases a fan-out run creates the same entities in, with
+    its own connection and what happened to it
+
+    Attributes
+    ----------
+    conninfo : str
+        the libpq connection string (or URI) of the database
+    name : str
+        the host, port and database of conninfo, without its credentials
+    conn : psycopg.AsyncConnection
+        the connection the target is written over, once opened
+    error : str
+        why the target failed, None while it has not. A failed target is
+        left out of the rest of the run, the others carry on.
+    existing : set
+        the ids of the rows of the entity type being created that the
+        database already has
+    rows : dict
+        the rows written to the target, by entity type
+    seconds : dict
+        the time the target's COPY took, by entity type
+    """
+
+    def __init__(self, conninfo: str) -> None:
+        self.conninfo: str = conninfo
+        params: Dict[str, str] = conninfo_to_dict(conninfo)
+        self.name: str = "{}{}/{}".format(
+            params.get("host", "localhost"),
+            ":" + params["port"] if params.get("port") else "",
+            params.get("dbname", params.get("user", "")),
+        )
+        self.conn: Optional[psycopg.AsyncConnection] = None
+        self.error: Optional[str] = None
+        self.existing: Set[uuid.UUID] = set()
+        self.rows: Dict[str, int] = {}
+        self.seconds: Dict[str, float] = {}
+
+    def fail(self, stage: str, exc: BaseException) -> None:
+        self.error = "{}: {}".format(stage, exc)
+        print("target {} failed on {}".format(self.name, self.error))
+
+    def summary(self) -> List[str]:
+        """a line for the target and one per entity type written to it"""
+        rows = sum(self.rows.values())
+        seconds = sum(self.seconds.values())
+        lines = [
+            "target {}: {} rows in {:.2f}s ({:.0f} rows/sec){}".format(
+                self.name,
+                rows,
+                seconds,
+                rows / seconds if seconds else 0,
+                ", failed on " + self.error.splitlines()[0] if self.error else "",
+            )
+        ]
+        for entity, count in self.rows.items():
+            lines.append(
+                "  {}: {} rows in {:.2f}s ({:.0f} rows/sec)".format(
+                    entity,
+                    count,
+                    self.seconds[entity],
+                    count / self.seconds[entity] if self.seconds[entity] else 0,
+                )
+            )
+        return lines
 
 
 class Runner(object):
@@ -25,6 +968,104 @@ class Runner(object):
     -------
     """
 
+    # the entity types the generated rows of each entity type reference, within
+    # one workspace, which the async engine loads them after
+    DEPENDENCIES: Dict[str, List[str]] = {
+        "workspaces": [],
+        "services": ["workspaces"],
+        "routes": ["services"],
+        "consumers": ["workspaces"],
+        "plugins": ["services"],
+    }
+
+    # the tables each table has foreign keys to. Unlike the plugins generated
+    # with the services, the plugins of an export include those scoped to
+    # routes and consumers, so importing them waits for those tables too
+    REFERENCES: Dict[str, List[str]] = {
+        "workspaces": [],
+        "services": ["workspaces"],
+        "routes": ["services"],
+        "consumers": ["workspaces"],
+        "plugins": ["services", "routes", "consumers"],
+    }
+
+    # the tables whose stores are looked up once they are written, for the
+    # workspaces to load and the services routes and plugins belong to. The
+    # stores of the others are only read to diff them, and are dropped once
+    # the table is written so that memory does not grow with their rows.
+    CACHED_TABLES: Tuple[str, ...] = ("workspaces", "services")
+
+    ROUTE_DUMP_FORMATS: Tuple[str, ...] = ("json", "ndjson", "csv")
+    # what --route-regex-path appends to route paths
+    ROUTE_REGEX_SUFFIX: str = "/\\w+$"
+    # what the route dump requests below routes that end in a slash or regex
+    ROUTE_REQUEST_RESOURCE: str = "fakeAccounts?count=10&sleep=90"
+
+    # the name and type oid of every column of a table
+    COLUMN_TYPES_SQL: str = """\
+        SELECT attname, atttypid FROM pg_attribute
+        WHERE attrelid = %s::regclass AND attnum > 0
+        AND NOT attisdropped;"""
+
+    # the bytes read from an exported file per COPY write when importing
+    IMPORT_READ_SIZE: int = 1024 * 1024
+
+    # the rows in the first batch when only a target commit time is given
+    DEFAULT_BATCH_SIZE: int = 10000
+
+    # the rows a fan-out run hands to each target's COPY at a time, and the
+    # batches queued per target before generating waits for it to catch up
+    FAN_OUT_BATCH: int = 1000
+    FAN_OUT_QUEUE: int = 8
+
+    # the most rows of a workspace a failed verify lists, per entity type
+    VERIFY_EXAMPLES: int = 10
+
+    # the columns --update brings in line with the config file, per table
+    UPDATE_COLUMNS: Dict[str, List[str]] = {
+        "services": [
+            "retries",
+            "protocol",
+            "host",
+            "port",
+            "path",
+            "connect_timeout",
+            "write_timeout",
+            "read_timeout",
+            "enabled",
+        ],
+        "routes": [
+            "protocols",
+            "paths",
+            "regex_priority",
+            "strip_path",
+            "preserve_host",
+            "https_redirect_status_code",
+            "path_handling",
+            "request_buffering",
+            "response_buffering",
+            "methods",
+            "hosts",
+        ],
+        "plugins": ["config", "enabled", "protocols"],
+    }
+
+    # the table a plugin can be attached to the rows of, the plugin column
+    # that holds their ids, and what comes before and after that id in the
+    # cache_key, plugins:<name>:<route_id>:<service_id>:<consumer_id>::<ws_id>
+    PLUGIN_SCOPES: Dict[str, Tuple[str, str, str, str]] = {
+        "service": ("services", "service_id", "::", ":::"),
+        "route": ("routes", "route_id", ":", "::::"),
+        "consumer": ("consumers", "consumer_id", ":::", "::"),
+    }
+
+    # the table each kind of churn updates
+    CHURN_TYPES: Dict[str, str] = {
+        "service_retries": "services",
+        "route_paths": "routes",
+        "plugin_configs": "plugins",
+    }
+
     def __init__(
         self,
         config_file=None,
@@ -35,6 +1076,41 @@ class Runner(object):
         route_prefix=None,
         route_trailing_slash=None,
         route_regex_path=None,
+        memory_report=False,
+        transaction="entity",
+        refresh=False,
+        workers=1,
+        partition=None,
+        copy_format="binary",
+        deterministic_ids=False,
+        bulk_load=False,
+        rebuild_indexes=False,
+        generate_in_db=False,
+        delete_prefix=False,
+        delete_batch_size=10000,
+        engine="sync",
+        concurrency=4,
+        metrics_file=None,
+        metrics_format="json",
+        export_dir=None,
+        import_dir=None,
+        compression="none",
+        route_dump_format="json",
+        route_dump_source="config",
+        commit_every=0,
+        journal_file="./import.journal",
+        resume=False,
+        churn=None,
+        churn_percent=10.0,
+        churn_rate=0.0,
+        churn_batch_size=100,
+        churn_duration=0.0,
+        verify=False,
+        update=False,
+        targets=None,
+        batch_size=0,
+        target_commit_ms=0.0,
+        batch_log=None,
     ) -> None:
         """
         Parameters
@@ -44,30 +1120,325 @@ class Runner(object):
         db_params: dict
             A dictionary of database connection parameters, used for accessing
             the Kong database
+        memory_report: bool
+            Print the peak resident set size after each entity type is created
+        transaction: str
+            How the entity types are committed, one of Session.TRANSACTION_MODES
+        refresh: bool
+            Re-read the tables of CACHED_TABLES from the database after writing
+            to them, instead of updating their stores from the rows that were
+            written or deleted
+        workers: int
+            The number of processes that services, routes, consumers and
+            plugins are loaded with, each one handles a share of the workspaces
+        partition: list
+            The indexes of the workspaces this runner is limited to, set on
+            the runners started by each worker
+        copy_format: str
+            The COPY format rows are sent in, binary or text
+        deterministic_ids: bool
+            Derive every id from the entity's name with UUIDv5, so the ids
+            that should exist are known without reading the tables
+        bulk_load: bool
+            COPY rows into unlogged staging tables and move them into the
+            Kong tables with one INSERT ... SELECT each, then ANALYZE
+        rebuild_indexes: bool
+            Drop the indexes that do not back a constraint before loading a
+            table and recreate them afterwards
+        generate_in_db: bool
+            Build the rows inside Postgres with INSERT ... SELECT over
+            generate_series instead of generating them here and COPYing them
+        delete_prefix: bool
+            Delete the entities of every workspace named with the prefix, not
+            only the workspaces the config asks for
+        delete_batch_size: int
+            The number of rows removed per transaction when deleting
+        engine: str
+            sync loads the entity types one after another, async loads them
+            concurrently, each as soon as the entities it depends on exist
+        concurrency: int
+            The number of connections the async engine loads over
+        metrics_file: str
+            A path to write the run's Metrics to once it ends
+        metrics_format: str
+            The format of the metrics file, one of Metrics.FORMATS
+        export_dir: str
+            Write the entities in the config's workspaces to COPY files in
+            this directory instead of creating anything
+        import_dir: str
+            Load the COPY files of an export from this directory instead of
+            generating entities
+        compression: str
+            How exported files are compressed, one of Archive.COMPRESSIONS
+        route_dump_format: str
+            How the route dump is written, one of ROUTE_DUMP_FORMATS
+        route_dump_source: str
+            config builds the dumped paths from the config, like the rows
+            are built, database reads the paths of the routes in the
+            config's workspaces once the run is done
+        commit_every: int
+            Create the entities workspace by workspace, committing every
+            commit_every rows and recording each finished workspace in the
+            journal
+        journal_file: str
+            The path of the Journal kept when committing in chunks
+        resume: bool
+            Carry on from the journal of an interrupted run, skipping the
+            workspaces it records as done
+        churn: list
+            Update existing entities in place instead of creating any, with
+            the kinds of update in CHURN_TYPES given
+        churn_percent: float
+            The percentage of the entities in the config's workspaces that
+            each kind of churn updates, chosen at random
+        churn_rate: float
+            The updates per second churn aims for, 0 for as fast as it can
+        churn_batch_size: int
+            The most rows updated per transaction when churning
+        churn_duration: float
+            The seconds churn runs for, 0 to run until it is interrupted
+        verify: bool
+            Check with aggregate queries that the database holds what the
+            config asks for, instead of creating anything
+        update: list
+            The tables of UPDATE_COLUMNS to bring in line with the config
+            file, or True for all of them, instead of creating anything.
+            Each table is updated with one UPDATE that only changes the rows
+            that differ
+        targets: list
+            The connection strings of more databases to create the same
+            entities in. Every row is generated once and sent to each
+            database that lacks it, over a COPY stream per database. Ids are
+            derived from names, as with deterministic_ids, so that a row is
+            the same in every database.
+        batch_size: int
+            Write each entity type in COPY batches of this many rows, each
+            committed on its own, 0 for one COPY per entity type
+        target_commit_ms: float
+            Size the batches so each one takes about this long from its
+            first row to its commit, adjusting them to the throughput
+            measured as the batches go, see BatchSizer
+        batch_log: str
+            A path to append a JSON line of stats for every batch to
         """
         self.config_file: str = config_file
         self.db_params: Dict[str, str] = db_params
+        self.metrics: Metrics = Metrics()
+        self.metrics_file: Optional[str] = metrics_file
+        self.metrics_format: str = metrics_format
+        self.session: Session = Session(
+            self.db_connect(self.db_params), transaction, self.metrics
+        )
         self.data: Dict[str, Any] = self.parse_config(self.config_file)
         self.prefix: str = self.data["prefix"]
         self.delete: bool = delete
         self.route_dump: bool = route_dump
-        self.route_dump_location = route_dump_location or "./routes.josn"
+        self.route_dump_format: str = route_dump_format
+        self.route_dump_source: str = route_dump_source
+        self.route_dump_location: str = route_dump_location or "./routes.{}".format(
+            route_dump_format
+        )
+        self.targets: List[str] = list(targets or [])
+        self.deterministic_ids: bool = deterministic_ids or bool(self.targets)
+        self.bulk_load: bool = bulk_load
+        self.rebuild_indexes: bool = rebuild_indexes
+        self.generate_in_db: bool = generate_in_db
+        self.delete_prefix: bool = delete_prefix
+        self.delete_batch_size: int = max(int(delete_batch_size), 1)
+        self.engine: str = engine
+        self.concurrency: int = max(int(concurrency), 1)
+        self.export_dir: Optional[str] = export_dir
+        self.import_dir: Optional[str] = import_dir
+        self.compression: str = compression
+        if export_dir and import_dir:
+            raise ValueError("a run can either export or import, not both")
+        self.commit_every: int = max(int(commit_every), 0)
+        self.journal: Journal = Journal(journal_file)
+        self.resume: bool = resume
+        if (self.commit_every or resume) and (
+            workers > 1
+            or engine == "async"
+            or generate_in_db
+            or rebuild_indexes
+            or transaction != "entity"
+        ):
+            raise ValueError(
+                "chunked commits and resume need the sync engine with one "
+                "worker and the entity transaction mode, and cannot be combined "
+                "with generate_in_db or rebuild_indexes"
+            )
+        self.churn: List[str] = list(dict.fromkeys(churn or []))
+        for churn_type in self.churn:
+            if churn_type not in self.CHURN_TYPES:
+                raise ValueError(
+                    "unknown churn type {}, expected one of {}".format(
+                        churn_type, ", ".join(self.CHURN_TYPES)
+                    )
+                )
+        self.churn_percent: float = float(churn_percent)
+        if not 0 < self.churn_percent <= 100:
+            raise ValueError("the churn percentage must be above 0 and at most 100")
+        self.churn_rate: float = max(float(churn_rate), 0.0)
+        self.churn_batch_size: int = max(int(churn_batch_size), 1)
+        self.churn_duration: float = max(float(churn_duration), 0.0)
+        if self.churn and (
+            export_dir
+            or import_dir
+            or delete
+            or delete_prefix
+            or transaction != "entity"
+        ):
+            raise ValueError(
+                "churn commits every batch on its own, it cannot be combined "
+                "with an export, an import, a delete or a transaction mode "
+                "other than entity"
+            )
+        self.verify: bool = verify
+        self.verified: Optional[bool] = None
+        if verify and (
+            export_dir or import_dir or delete or delete_prefix or self.churn
+        ):
+            raise ValueError(
+                "verify only reads, it cannot be combined with an export, an "
+                "import, a delete or churn"
+            )
+        self.update: List[str] = list(
+            self.UPDATE_COLUMNS if update is True else dict.fromkeys(update or [])
+        )
+        for table in self.update:
+            if table not in self.UPDATE_COLUMNS:
+                raise ValueError(
+                    "cannot update {}, expected one of {}".format(
+                        table, ", ".join(self.UPDATE_COLUMNS)
+                    )
+                )
+        if self.update and (
+            export_dir
+            or import_dir
+            or delete
+            or delete_prefix
+            or self.churn
+            or verify
+            or self.targets
+        ):
+            raise ValueError(
+                "update only changes the entities that exist, it cannot be "
+                "combined with an export, an import, a delete, churn, verify "
+                "or fan-out"
+            )
+        if self.targets and (
+            workers > 1
+            or engine == "async"
+            or generate_in_db
+            or bulk_load
+            or rebuild_indexes
+            or self.commit_every
+            or resume
+            or transaction != "entity"
+            or export_dir
+            or import_dir
+            or delete
+            or delete_prefix
+            or self.churn
+            or verify
+        ):
+            raise ValueError(
+                "fan-out to several databases only creates entities, with one "
+                "COPY per database and entity type, it cannot be combined with "
+                "workers, the async engine, generate_in_db, bulk_load, "
+                "rebuild_indexes, chunked commits, a transaction mode other "
+                "than entity, an export, an import, a delete, churn or verify"
+            )
+        self.failed_targets: List[Target] = []
+        self.batch_size: int = max(int(batch_size), 0)
+        self.target_commit_ms: float = max(float(target_commit_ms), 0.0)
+        self.batching: bool = bool(self.batch_size or self.target_commit_ms)
+        self.batch_log: Optional[str] = batch_log
+        if self.batching and (
+            workers > 1
+            or engine == "async"
+            or generate_in_db
+            or self.commit_every
+            or resume
+            or self.targets
+            or transaction != "entity"
+        ):
+            raise ValueError(
+                "batches are committed one by one by the sync engine with one "
+                "worker, in the entity transaction mode, they cannot be "
+                "combined with generate_in_db, chunked commits or fan-out"
+            )
+        if self.engine == "async" and (
+            workers > 1 or generate_in_db or transaction != "entity"
+        ):
+            raise ValueError(
+                "the async engine commits each load on its own connection, it "
+                "cannot be combined with workers, generate_in_db or a "
+                "transaction mode other than entity"
+            )
+        if generate_in_db and self.deterministic_ids:
+            raise ValueError(
+                "generate_in_db takes its ids from gen_random_uuid(), it cannot "
+                "be combined with deterministic_ids"
+            )
         self.required_workspaces: List[List[str]] = self.gen_workspaces(
             self.data["workspaces"]
         )
+        if partition is not None:
+            self.required_workspaces = [self.required_workspaces[i] for i in partition]
         self.required_workspace_names: List[str] = [
             v[1] for v in self.required_workspaces
         ]
+        self.required_workspace_ids: Dict[str, str] = {
+            v[1]: v[0] for v in self.required_workspaces
+        }
         self.route_prefix = route_prefix
         self.route_trailing_slash = route_trailing_slash
         self.route_regex_path = route_regex_path
+        self.memory_report: bool = memory_report
+        self.memory_usage: Dict[str, int] = {}
+        self.refresh: bool = refresh
+        self.workers: int = max(int(workers), 1)
+        self.partition: Optional[List[int]] = partition
+        self.copy_format: str = copy_format
+        self.column_types: Dict[str, Dict[str, int]] = {}
+        self.created: Dict[str, int] = {}
+        self.options: Dict[str, Any] = {
+            "config_file": config_file,
+            "db_params": db_params,
+            "route_prefix": route_prefix,
+            "route_trailing_slash": route_trailing_slash,
+            "route_regex_path": route_regex_path,
+            "memory_report": memory_report,
+            "transaction": transaction,
+            "refresh": refresh,
+            "copy_format": copy_format,
+            "deterministic_ids": deterministic_ids,
+            "bulk_load": bulk_load,
+            "generate_in_db": generate_in_db,
+        }
 
         self.number_of_services: int = int(self.data["services_per_workspace"])
         self.number_of_routes: int = int(self.data["routes_per_service"])
         self.number_of_consumers: int = int(self.data["consumers_per_workspace"])
         self.number_of_plugins: int = len(self.data["plugins"]) or 0
         self.plugins = self.data["plugins"] or {}
+        self.plugin_scopes: Dict[str, Dict[str, Decimal]] = self.parse_plugin_scopes()
+        # the plugins on every service are created like the other entities,
+        # those on routes, consumers or some of the services in the database
+        self.service_plugins: List[str] = [
+            name
+            for name, scopes in self.plugin_scopes.items()
+            if scopes.get("service") == 100
+        ]
+        self.scoped_plugins: List[Tuple[str, str, Decimal]] = [
+            (name, scope, percent)
+            for name, scopes in self.plugin_scopes.items()
+            for scope, percent in scopes.items()
+            if percent and not (scope == "service" and percent == 100)
+        ]
         self.svc_defaults = self.get_svc_defaults(self.data)
+        self.compile_row_templates()
 
         self.entites: List[str] = [
             "workspaces",
@@ -77,11 +1448,12 @@ class Runner(object):
             "plugins",
         ]
 
+        # the columns read into each EntityStore, in the order of its add
         self.get_items: Dict[str, List[str]] = {
-            "workspaces": ["name", "id"],
+            "workspaces": ["id", "name"],
             "services": ["id", "name", "ws_id"],
-            "routes": ["id", "name", "service_id", "ws_id"],
-            "plugins": ["id", "name", "service_id", "cache_key", "ws_id"],
+            "routes": ["id", "name", "ws_id", "service_id"],
+            "plugins": ["id", "name", "ws_id", "service_id"],
             "consumers": ["id", "username", "ws_id"],
         }
 
@@ -141,14 +1513,6 @@ class Runner(object):
             ],
         }
 
-        self.get_entity_data: Dict[str, Any] = {
-            "workspaces": self.workspaces_parser,
-            "services": self.services_parser,
-            "routes": self.routes_parser,
-            "consumers": self.consumers_parser,
-            "plugins": self.plugins_parser,
-        }
-
         self.entity_data_hydrate: Dict[str, Any] = {
             "workspaces": self.workspaces_data_hydrate,
             "services": self.services_data_hydrate,
@@ -157,480 +1521,2478 @@ class Runner(object):
             "plugins": self.plugins_data_hydrate,
         }
 
-        self.db_cache: Dict[str, Any] = {
-            "workspaces": {},
-            "services": {},
-            "routes": {},
-            "consumers": {},
-            "plugins": {},
-        }
-
-        self.parse_cache: Dict[str, Any] = {
-            "workspaces": {},
-            "services": {},
-            "routes": {},
-            "consumers": {},
-            "plugins": {},
-        }
-
-        self.composit_cache: Dict[str, Any] = {
-            "workspaces": [],
-            "services": [],
-            "routes": [],
-            "consumers": [],
-            "plugins": [],
-        }
+        # the rows of each table in this run's workspaces, None until read
+        self.stores: Dict[str, Optional[EntityStore]] = dict.fromkeys(self.entites)
 
-        self.require_strings: Dict[str, Any] = {
-            "workspaces": self.workspaces_require_string,
-            "services": self.services_require_string,
-            "routes": self.routes_require_string,
-            "consumers": self.consumers_require_string,
-            "plugins": self.plugins_require_string,
+        self.require_keys: Dict[str, Any] = {
+            "workspaces": self.workspaces_require_keys,
+            "services": self.services_require_keys,
+            "routes": self.routes_require_keys,
+            "consumers": self.consumers_require_keys,
+            "plugins": self.plugins_require_keys,
         }
-        if self.route_dump:
-            print("dumping routes")
-            with open(self.route_dump_location, "w") as f:
-                json.dump(self.dump_routes(), f)
-        if self.delete:
+        if self.route_dump and self.route_dump_source == "config":
+            self.dump_routes()
+        if self.export_dir:
+            print("exporting entities")
+            self.export_tables()
+        elif self.import_dir:
+            print("importing entities")
+            self.import_tables()
+        elif self.delete or self.delete_prefix:
             print("deleting entities")
             self.delete_entities()
+        elif self.churn:
+            print("churning entities")
+            self.churn_entities()
+        elif self.verify:
+            print("verifying entities")
+            self.verify_entities()
+        elif self.update:
+            print("updating entities")
+            self.update_entities()
         else:
             print("creating entities")
             self.create_entities()
+        if self.route_dump and self.route_dump_source == "database":
+            self.dump_routes()
 
     ################# Data parsers #############################
 
-    def workspaces_require_string(self) -> List[str]:
-        return ["{}^{}".format(v[0], v[1]) for v in self.required_workspaces]
+    def workspaces_require_keys(self) -> Iterator[Tuple[str, ...]]:
+        return ((v[1],) for v in self.required_workspaces)
 
-    def consumers_require_string(self) -> List[str]:
-        return [
-            "{}-consumer-{}^{}".format(k, i, v["id"])
+    def consumers_require_keys(self) -> Iterator[Tuple[str, ...]]:
+        workspaces = self.active_workspaces()
+        return (
+            ("{}-consumer-{}".format(name, i), id_)
             for i in range(self.number_of_consumers)
-            for k, v in self.get_active_entities_data("workspaces").items()
-        ]
+            for name, id_ in workspaces
+        )
 
-    def services_require_string(self) -> List[str]:
-        return [
-            "{}-svc-{}^{}".format(k, i, v["id"])
+    def services_require_keys(self) -> Iterator[Tuple[str, ...]]:
+        workspaces = self.active_workspaces()
+        return (
+            ("{}-svc-{}".format(name, i), id_)
             for i in range(self.number_of_services)
-            for k, v in self.get_active_entities_data("workspaces").items()
-        ]
+            for name, id_ in workspaces
+        )
 
-    def dump_routes(self) -> List[str]:
-        routes = []
+    def config_route_paths(self) -> Iterator[str]:
+        """the path of every route the config asks for, built like the rows"""
         for ws in self.required_workspace_names:
             for s in range(self.number_of_services):
                 for r in range(self.number_of_routes):
-                    if self.route_prefix:
-                        path = "{}/{}-svc-{}-route-{}".format(self.prefix, ws, s, r)
-                    else:
-                        path = "{}-svc-{}-route-{}".format(ws, s, r)
-                    if self.route_trailing_slash:
-                        path = path + "/fakeAccounts?count=10&sleep=90"
-                    routes.append(path)
-        return routes
-
-    def routes_require_string(self) -> List[str]:
-        return [
-            "{}-route-{}^{}^{}".format(v["name"], i, k, v["ws_id"])
-            for i in range(self.number_of_routes)
-            for k, v in self.get_active_entities_data("services").items()
-        ]
+                    name = "{}-svc-{}-route-{}".format(ws, s, r)
+                    yield self.route_path_prefix + name + self.route_path_suffix
 
-    def plugins_require_string(self) -> List[str]:
-        return [
-            "{}^{}^{}".format(p, k, v["ws_id"])
-            for p in self.plugins
-            for k, v in self.get_active_entities_data("services").items()
-        ]
+    def database_route_paths(self) -> Iterator[str]:
+        """the paths of the routes in this run's workspaces, streamed by COPY"""
+        column, type_, values = self.scope_filter("routes")
+        if not values:
+            return
+        with self.session.cursor() as cursor:
+            with cursor.copy(
+                sql.SQL(
+                    "COPY (SELECT unnest(paths) FROM routes WHERE {} = ANY({}::{}[])) "
+                    "TO STDOUT"
+                ).format(
+                    sql.Identifier(column), sql.Literal(list(values)), sql.SQL(type_)
+                )
+            ) as copy:
+                for row in copy.rows():
+                    yield row[0]
 
-    def workspaces_data_hydrate(self, comp: str = ""):
-        p = comp.split("^")
-        id_ = p[0]
-        name = p[1]
-        meta = '{"color": "#3894f0"%"thumbnail": null}'
-        return "{},{},{}".format(id_, name, meta)
-
-    def services_data_hydrate(self, comp: str):
-        p = comp.split("^")
-        name = p[0]
-        ws_id = p[1]
-        created_at = datetime.now(timezone.utc).strftime("%Y-%m-%d %X+00")
-        retries = self.svc_defaults["retries"]
-        protocol = self.svc_defaults["protocol"]
-        host = self.svc_defaults["host"]
-        port = self.svc_defaults["port"]
-        path = self.svc_defaults["path"]
-        connect_timeout = self.svc_defaults["connect_timeout"]
-        write_timeout = self.svc_defaults["write_timeout"]
-        read_timeout = self.svc_defaults["read_timeout"]
-        return "{},{},{},{},{},{},{},{},{},{},{},true,{},{}".format(
-            uuid.uuid4(),
-            name,
-            retries,
-            protocol,
-            host,
-            port,
-            path,
-            connect_timeout,
-            write_timeout,
-            read_timeout,
-            ws_id,
-            created_at,
-            created_at,
-        )
-
-    def consumers_data_hydrate(self, comp: str):
-        p = comp.split("^")
-        username = p[0]
-        ws_id = p[1]
-        username_lower = username
-        type_ = "0"
-        return "{},{},{},{},{}".format(
-            uuid.uuid4(), username, ws_id, username_lower, type_
-        )
-
-    def routes_data_hydrate(self, comp: str):
-        p = comp.split("^")
-        name = p[0]
-        service_id = p[1]
-        ws_id = p[2]
-        created_at = datetime.now(timezone.utc).strftime("%Y-%m-%d %X+00")
-        if self.route_prefix:
-            path = "/" + self.prefix + "/" + name
+    def request_path(self, path: str) -> str:
+        """
+        The path a load test requests to reach a route with this path,
+        without its leading slash. Routes ending in a slash or in the regex
+        suffix get a request for a resource below them.
+        """
+        if path.endswith(self.ROUTE_REGEX_SUFFIX):
+            path = path[: -len(self.ROUTE_REGEX_SUFFIX)] + "/"
+        if path.endswith("/"):
+            path = path + self.ROUTE_REQUEST_RESOURCE
+        return path[1:] if path.startswith("/") else path
+
+    def dump_routes(self) -> None:
+        """
+        Stream the request path of every route to route_dump_location in
+        route_dump_format, from the config or from the database
+        """
+        print("dumping routes")
+        if self.route_dump_source == "database":
+            paths = self.database_route_paths()
         else:
-            path = "/" + name
+            paths = self.config_route_paths()
+        with open(self.route_dump_location, "w", newline="") as f:
+            count = write_paths(
+                f, map(self.request_path, paths), self.route_dump_format
+            )
+        self.session.close()
+        print("dumped {} route paths to {}".format(count, self.route_dump_location))
+
+    def routes_require_keys(self) -> Iterator[Tuple[str, ...]]:
+        services = self.active_services()
+        return (
+            ("{}-route-{}".format(name, i), id_, ws_id)
+            for i in range(self.number_of_routes)
+            for name, id_, ws_id in services
+        )
+
+    def plugins_require_keys(self) -> Iterator[Tuple[str, ...]]:
+        services = self.active_services()
+        return (
+            (p, id_, ws_id) for p in self.service_plugins for _, id_, ws_id in services
+        )
+
+    def deterministic_keys(
+        self, entity: str
+    ) -> Iterator[Tuple[uuid.UUID, Tuple[str, ...]]]:
+        """
+        Yield the id and key of every entity of this type that the config
+        asks for, with the ids of parents derived the same way, so nothing
+        has to be read from the database
+        """
+        for ws_name, ws_id in self.required_workspace_ids.items():
+            if entity == "workspaces":
+                yield uuid.UUID(ws_id), (ws_name,)
+            elif entity == "consumers":
+                for i in range(self.number_of_consumers):
+                    name = "{}-consumer-{}".format(ws_name, i)
+                    yield deterministic_id(entity, name), (name, ws_id)
+            else:
+                for s in range(self.number_of_services):
+                    svc_name = "{}-svc-{}".format(ws_name, s)
+                    svc_id = deterministic_id("services", svc_name)
+                    if entity == "services":
+                        yield svc_id, (svc_name, ws_id)
+                    elif entity == "routes":
+                        for r in range(self.number_of_routes):
+                            name = "{}-route-{}".format(svc_name, r)
+                            yield deterministic_id(entity, name), (
+                                name,
+                                str(svc_id),
+                                ws_id,
+                            )
+                    elif entity == "plugins":
+                        for p in self.service_plugins:
+                            name = "{}:{}".format(p, svc_name)
+                            yield deterministic_id(entity, name), (
+                                p,
+                                str(svc_id),
+                                ws_id,
+                            )
+
+    def compile_row_templates(self) -> None:
+        """
+        Work out once per run the parts of each row that are the same for
+        every entity of a type: the service settings, the created_at
+        timestamp, the constant arrays, the route path affixes and the plugin
+        configs, serialized once. The *_data_hydrate functions then only
+        fill in ids, names and keys.
+        """
+        self.random_ids: Iterator[uuid.UUID] = random_ids()
+        self.created_at: datetime = datetime.now(timezone.utc).replace(microsecond=0)
+        self.workspace_uuids: Dict[str, uuid.UUID] = {}
+        self.workspace_meta: Jsonb = Jsonb({"color": "#3894f0", "thumbnail": None})
+        self.service_settings: Tuple[Any, ...] = (
+            int(self.svc_defaults["retries"]),
+            self.svc_defaults["protocol"],
+            self.svc_defaults["host"],
+            int(self.svc_defaults["port"]),
+            self.svc_defaults["path"],
+            int(self.svc_defaults["connect_timeout"]),
+            int(self.svc_defaults["write_timeout"]),
+            int(self.svc_defaults["read_timeout"]),
+        )
+        self.route_path_prefix: str = (
+            "/" + self.prefix + "/" if self.route_prefix else "/"
+        )
         if self.route_trailing_slash:
-            path = path + "/"
+            self.route_path_suffix: str = "/"
         elif self.route_regex_path:
-            path = path + "/\\\w+$"
-        return "{},{},{},{{http% https}},{{{}}},0,true,false,426,v0,{},true,true,{{GET% POST}},{},{},{{}}".format(
-            uuid.uuid4(),
+            self.route_path_suffix = self.ROUTE_REGEX_SUFFIX
+        else:
+            self.route_path_suffix = ""
+        self.route_protocols: List[str] = ["http", "https"]
+        self.route_methods: List[str] = ["GET", "POST"]
+        self.route_hosts: List[str] = []
+        self.plugin_protocols: List[str] = ["grpc", "grpcs", "http", "https"]
+        # the jsonb dumper calls dumps on the wrapped object for every row,
+        # wrapping the serialized config with str as dumps makes that a no-op
+        self.plugin_configs: Dict[str, Jsonb] = {
+            name: Jsonb(json.dumps(plugin["config"]), dumps=str)
+            for name, plugin in self.plugins.items()
+        }
+
+    def workspace_uuid(self, ws_id: str) -> uuid.UUID:
+        """the UUID of a workspace id, parsed once per workspace"""
+        value = self.workspace_uuids.get(ws_id)
+        if value is None:
+            value = self.workspace_uuids[ws_id] = uuid.UUID(ws_id)
+        return value
+
+    def workspaces_data_hydrate(
+        self, key: Tuple[str, ...], id_: Optional[uuid.UUID] = None
+    ) -> Tuple[Any, ...]:
+        name = key[0]
+        id_ = id_ or uuid.UUID(self.required_workspace_ids[name])
+        return (id_, name, self.workspace_meta)
+
+    def services_data_hydrate(
+        self, key: Tuple[str, ...], id_: Optional[uuid.UUID] = None
+    ) -> Tuple[Any, ...]:
+        name, ws_id = key
+        return (
+            id_ or next(self.random_ids),
+            name,
+            *self.service_settings,
+            self.workspace_uuid(ws_id),
+            True,
+            self.created_at,
+            self.created_at,
+        )
+
+    def consumers_data_hydrate(
+        self, key: Tuple[str, ...], id_: Optional[uuid.UUID] = None
+    ) -> Tuple[Any, ...]:
+        username, ws_id = key
+        return (
+            id_ or next(self.random_ids),
+            username,
+            self.workspace_uuid(ws_id),
+            username,
+            0,
+        )
+
+    def routes_data_hydrate(
+        self, key: Tuple[str, ...], id_: Optional[uuid.UUID] = None
+    ) -> Tuple[Any, ...]:
+        name, service_id, ws_id = key
+        return (
+            id_ or next(self.random_ids),
             name,
-            service_id,
-            path,
-            ws_id,
-            created_at,
-            created_at,
-        )
-
-    def plugins_data_hydrate(self, comp: str):
-        p = comp.split("^")
-        name = p[0]
-        service_id = p[1]
-        ws_id = p[2]
-        cache_key = "plugins:{}::{}:::{}".format(name, service_id, ws_id)
-        return "{},{},{},CONFIG,true,{},{{grpc%grpcs%http%https}},{}".format(
-            uuid.uuid4(),
+            uuid.UUID(service_id),
+            self.route_protocols,
+            [self.route_path_prefix + name + self.route_path_suffix],
+            0,
+            True,
+            False,
+            426,
+            "v0",
+            self.workspace_uuid(ws_id),
+            True,
+            True,
+            self.route_methods,
+            self.created_at,
+            self.created_at,
+            self.route_hosts,
+        )
+
+    def plugins_data_hydrate(
+        self, key: Tuple[str, ...], id_: Optional[uuid.UUID] = None
+    ) -> Tuple[Any, ...]:
+        name, service_id, ws_id = key
+        return (
+            id_ or next(self.random_ids),
             name,
-            service_id,
-            cache_key,
-            ws_id,
+            uuid.UUID(service_id),
+            self.plugin_configs[name],
+            True,
+            "plugins:{}::{}:::{}".format(name, service_id, ws_id),
+            self.plugin_protocols,
+            self.workspace_uuid(ws_id),
+        )
+
+    ################### Helper functions #########################
+
+    def parse_config(self, config_file) -> Dict[str, Any]:
+        d = {}
+        with open(config_file, "r") as stream:
+            try:
+                d = yaml.safe_load(stream)
+            except yaml.YAMLError as exc:
+                print(exc)
+        return d
+
+    def parse_plugin_scopes(self) -> Dict[str, Dict[str, Decimal]]:
+        """
+        The percentage of the services, routes and consumers of each
+        workspace that each plugin is attached to, from its scopes key. A
+        plugin without one is attached to every service.
+        """
+        scopes: Dict[str, Dict[str, Decimal]] = {}
+        for name, plugin in self.plugins.items():
+            given = plugin.get("scopes")
+            if given is None:
+                given = {"service": 100}
+            scopes[name] = {}
+            for scope, percent in given.items():
+                if scope not in self.PLUGIN_SCOPES:
+                    raise ValueError(
+                        "unknown scope {} for plugin {}, expected one of {}".format(
+                            scope, name, ", ".join(self.PLUGIN_SCOPES)
+                        )
+                    )
+                scopes[name][scope] = Decimal(str(percent))
+                if not 0 <= scopes[name][scope] <= 100:
+                    raise ValueError(
+                        "the {} scope of plugin {} must be a percentage from 0 "
+                        "to 100".format(scope, name)
+                    )
+        return scopes
+
+    def scope_size(self, scope: str) -> int:
+        """the services, routes or consumers of a workspace"""
+        return {
+            "service": self.number_of_services,
+            "route": self.number_of_services * self.number_of_routes,
+            "consumer": self.number_of_consumers,
+        }[scope]
+
+    def scoped_count(self, scope: str, percent: Decimal) -> int:
+        """the rows of a workspace a plugin attached to percent of scope has"""
+        return int(self.scope_size(scope) * percent / 100)
+
+    def get_svc_defaults(self, data: Dict[str, str]) -> Dict[str, str]:
+        return {
+            "protocol": self.set_param("service_protocol", "http", data),
+            "host": self.set_param("service_host", "httpbin.org", data),
+            "port": self.set_param("service_port", "80", data),
+            "path": self.set_param("service_path", "/", data),
+            "retries": self.set_param("service_retries", "5", data),
+            "connect_timeout": self.set_param("service_connect_timeout", "60000", data),
+            "write_timeout": self.set_param("service_write_timeout", "60000", data),
+            "read_timeout": self.set_param("service_read_timeout", "60000", data),
+        }
+
+    def set_param(self, value: str, default: str, data: Dict[str, str]) -> str:
+        return data[value] if value in data.keys() else default
+
+    def db_connect(self, params: Dict[str, str]) -> str:
+        hostname = self.set_param("hostname", "127.0.0.1", params)
+        database = self.set_param("database", "kong", params)
+        username = self.set_param("username", "kong", params)
+        password = self.set_param("password", "kong", params)
+        return "host={} dbname={} user={} password={}".format(
+            hostname, database, username, password
+        )
+
+    def items_str(self, items: List[str]) -> str:
+        return ", ".join(items)
+
+    def name_gen(self, quantity: int, entity: str) -> List[List[str]]:
+        data = []
+        for e in range(quantity):
+            name = "{}-{}-{}".format(self.prefix, entity, e)
+            if self.deterministic_ids:
+                id_ = deterministic_id("{}s".format(entity), name)
+            else:
+                id_ = uuid.uuid4()
+            data.append([str(id_), name])
+        return data
+
+    def gen_workspaces(self, quantity) -> List[List[str]]:
+        return self.name_gen(quantity, "workspace")
+
+    def report_memory(self, entity: str) -> None:
+        peak = peak_rss()
+        self.memory_usage[entity] = peak
+        print("{} peak rss: {:.1f} MiB".format(entity, peak / 1024 / 1024))
+
+    ################# Create functions ###########################
+
+    def get_active_entities_data(self, entity: str) -> EntityStore:
+        """the store of entity's rows in this run's workspaces, read once"""
+        store: Optional[EntityStore] = self.stores[entity]
+        if store is None:
+            store = self.get_entities(self.get_items[entity], entity)
+            self.stores[entity] = store
+        return store
+
+    def active_workspaces(self) -> List[Tuple[str, str]]:
+        """the name and id of every workspace of this run that exists"""
+        return [
+            (r.name, r.id)
+            for r in self.get_active_entities_data("workspaces").records()
+        ]
+
+    def active_services(self) -> List[Tuple[str, str, str]]:
+        """the name, id and workspace id of every service of this run"""
+        return [
+            (r.name, r.id, r.ws_id)
+            for r in self.get_active_entities_data("services").records()
+        ]
+
+    def get_active_filter(self, entity: str) -> Set[str]:
+        """
+        the values the parser for entity filters on, workspace names for
+        workspaces and the ids of the required workspaces for everything else
+        """
+        required_workspace_names: Set[str] = set(self.required_workspace_names)
+        if entity == "workspaces":
+            return required_workspace_names
+
+        return {
+            r.id
+            for r in self.get_active_entities_data("workspaces").records()
+            if r.name in required_workspace_names
+        }
+
+    def scope_filter(self, table: str) -> Tuple[str, str, Set[str]]:
+        """
+        The column, its type and the values that reads from table are
+        restricted to, so only the workspaces this run works on are fetched
+        """
+        if table == "workspaces":
+            return "name", "text", self.get_active_filter(table)
+        return "ws_id", "uuid", self.get_active_filter(table)
+
+    def entities_to_create(self, entity: str) -> Iterator[Tuple[Any, ...]]:
+        """
+        Resolve the existing keys up front, then return a generator that
+        hydrates each missing entity only as the COPY consumes it
+        """
+        existing: EntityStore = self.get_active_entities_data(entity)
+        required = self.metrics.count(
+            entity, "rows_diffed", self.require_keys[entity]()
         )
+        missing = iter_diff(required, existing)
+        return self.hydrate_rows(entity, zip(missing, repeat(None)))
 
-    def workspaces_parser(
+    def hydrate_rows(
         self,
-        current: Dict[str, Any],
-        required: List[str],
         entity: str,
-    ) -> Dict[str, Any]:
-        parsed_data = self.parse_cache[entity]
+        keys: Iterable[Tuple[Tuple[str, ...], Optional[uuid.UUID]]],
+    ) -> Iterator[Tuple[Any, ...]]:
+        """
+        Hydrate each (key, id) pair, a None id getting a random one, and
+        record the time spent hydrating, adding it to the stream consuming
+        the rows as well
+        """
+        hydrate = self.entity_data_hydrate[entity]
+        elapsed = 0.0
+        for key, id_ in keys:
+            start = time.perf_counter()
+            row = hydrate(key, id_)
+            seconds = time.perf_counter() - start
+            elapsed += seconds
+            hydrated: Optional[List[float]] = STREAM_HYDRATE.get()
+            if hydrated is not None:
+                hydrated[0] += seconds
+            yield row
+        self.metrics.add_time(entity, "hydrate", elapsed)
+
+    def deterministic_entities_to_create(
+        self, entity: str
+    ) -> Iterator[Tuple[Any, ...]]:
+        """
+        Look up which of the required ids already exist, then return a
+        generator that hydrates the rest with their deterministic ids
+        """
+        existing: Set[uuid.UUID] = self.get_existing_ids(
+            entity, (id_ for id_, _ in self.deterministic_keys(entity))
+        )
+        required = self.metrics.count(
+            entity, "rows_diffed", self.deterministic_keys(entity)
+        )
+        return self.hydrate_rows(
+            entity, ((key, id_) for id_, key in required if id_ not in existing)
+        )
 
-        if parsed_data:
-            return parsed_data
+    def create_entity(self, entity: str) -> None:
+        if self.generate_in_db:
+            entities_needed: Iterator[Tuple[Any, ...]] = iter(())
+        elif self.deterministic_ids:
+            entities_needed: Iterator[
+                Tuple[Any, ...]
+            ] = self.deterministic_entities_to_create(entity)
         else:
-            self.parse_cache[entity] = {
-                k: v for k, v in current.items() if v["name"] in required
-            }
-            return self.parse_cache[entity]
+            entities_needed: Iterator[Tuple[Any, ...]] = self.entities_to_create(entity)
+        indexes: List[str] = self.drop_indexes(entity) if self.rebuild_indexes else []
+        try:
+            if self.generate_in_db:
+                self.generate_into_table(entity)
+            else:
+                self.insert_into_table(
+                    entity, self.insert_items[entity], entities_needed
+                )
+        except BaseException:
+            # a failed stage rolls the dropped indexes back with it, but
+            # batches run outside of any stage and the drop is committed
+            if self.batching:
+                self.create_indexes(entity, indexes)
+            raise
+        self.create_indexes(entity, indexes)
+        self.metrics.record_rss(entity)
+        if self.memory_report:
+            self.report_memory(entity)
 
-    def services_parser(
-        self, current: Dict[str, Any], active: List[str], entity: str
-    ) -> Dict[str, Any]:
-        parsed_data = self.parse_cache[entity]
-        if parsed_data:
-            return parsed_data
+    ################ Delete functions ##############################
+
+    def get_delete_workspace_ids(self) -> List[str]:
+        """
+        The ids of the workspaces whose entities are deleted: every workspace
+        named with the prefix when delete_prefix is set, otherwise the ones
+        the config asks for
+        """
+        if self.delete_prefix:
+            pattern = "{}-workspace-%".format(re.sub(r"([\\%_])", r"\\\1", self.prefix))
+            with self.session.cursor() as cursor:
+                cursor.execute(
+                    "SELECT id FROM workspaces WHERE name LIKE %s;", (pattern,)
+                )
+                return [str(row[0]) for row in cursor.fetchall()]
+        if self.deterministic_ids:
+            return list(self.required_workspace_ids.values())
+        return list(self.get_active_filter("services"))
+
+    def delete_entity(self, entity: str, ws_ids: List[str]) -> None:
+        column: str = "id" if entity == "workspaces" else "ws_id"
+        self.delete_in_batches(entity, column, ws_ids)
+        self.analyze_tables([entity])
+        if self.refresh and entity in self.CACHED_TABLES:
+            self.refresh_cache(entity)
         else:
-            return {
-                v["id"]: {
-                    "name": v["name"],
-                    "ws_id": v["ws_id"],
-                    "composit": "{}^{}".format(v["name"], v["ws_id"]),
-                }
-                for v in current.values()
-                if v["ws_id"] in active
-            }
+            self.clear_cache(entity)
+        self.metrics.record_rss(entity)
 
-    def routes_parser(
-        self, current: Dict[str, Any], active: List[str], entity: str
-    ) -> Dict[str, Any]:
-        parsed_data = self.parse_cache[entity]
-        if parsed_data:
-            return parsed_data
+    ################ Cache functions ##############################
+
+    def cache_rows(self, table: str, written: EntityStore) -> None:
+        """
+        Add rows that were just written to the table's store, instead of
+        reading the table back from the database. A store that was never
+        read is left to be read, rows written included, when needed.
+        """
+        store: Optional[EntityStore] = self.stores[table]
+        if store is not None:
+            store.update(written)
+
+    def clear_cache(self, table: str) -> None:
+        self.stores[table] = None
+
+    def refresh_cache(self, table: str) -> None:
+        """Re-read a whole table from the database into its store"""
+        self.stores[table] = self.get_entities(self.get_items[table], table)
+
+    ################ SQL function ################################
+
+    def get_entities(
+        self, items: List[str], table: str, values: Optional[Set[str]] = None
+    ) -> EntityStore:
+        """
+        Read the items columns of table's rows in this run's scope, or in
+        the workspaces (ids, or names for workspaces) values when given,
+        into an EntityStore
+        """
+        data = EntityStore.for_table(table)
+        column, type_, scope = self.scope_filter(table)
+        values = scope if values is None else values
+        if not values:
+            return data
+        where = sql.SQL("{} = ANY({}::{}[])").format(
+            sql.Identifier(column), sql.Literal(list(values)), sql.SQL(type_)
+        )
+        if table == "plugins":
+            # plugins on routes and consumers are generated in the database,
+            # nothing is looked up by their keys
+            where = sql.SQL("{} AND route_id IS NULL AND consumer_id IS NULL").format(
+                where
+            )
+        with self.metrics.phase(table, "read"), self.session.cursor() as cursor:
+            with cursor.copy(
+                sql.SQL("COPY (SELECT {} FROM {} WHERE {}) TO STDOUT").format(
+                    sql.SQL(self.items_str(items)), sql.Identifier(table), where
+                )
+            ) as copy:
+                for row in copy.rows():
+                    data.add(*row)
+        self.metrics.add(table, "rows_read", len(data))
+        return data
+
+    def get_column_types(self, table: str, items: List[str]) -> List[int]:
+        """the type oids of the items columns of table, read once per table"""
+        types: Dict[str, int] = self.column_types.get(table, {})
+        if not types:
+            with self.session.cursor() as cursor:
+                cursor.execute(self.COLUMN_TYPES_SQL, (table,))
+                types = {name: int(oid) for name, oid in cursor.fetchall()}
+            self.column_types[table] = types
+        return [types[i] for i in items]
+
+    def generate_sql(self, table: str) -> str:
+        """
+        An INSERT ... SELECT that builds the rows of table inside Postgres,
+        producing the same values as the matching *_data_hydrate function
+        """
+        if table == "workspaces":
+            select = """\
+                SELECT gen_random_uuid(), w.name, %(meta)s
+                FROM unnest(%(workspaces)s::text[]) AS w(name)"""
+        elif table == "services":
+            select = """\
+                SELECT gen_random_uuid(), w.name || '-svc-' || s, %(retries)s,
+                    %(protocol)s, %(host)s, %(port)s, %(path)s,
+                    %(connect_timeout)s, %(write_timeout)s, %(read_timeout)s,
+                    w.id, true, now(), now()
+                FROM workspaces w
+                CROSS JOIN generate_series(0, %(services)s - 1) AS s
+                WHERE w.name = ANY(%(workspaces)s)"""
+        elif table == "routes":
+            select = """\
+                SELECT gen_random_uuid(), s.name || '-route-' || r, s.id,
+                    '{http,https}',
+                    ARRAY[%(path_prefix)s || s.name || '-route-' || r
+                        || %(path_suffix)s],
+                    0, true, false, 426, 'v0', s.ws_id, true, true,
+                    '{GET,POST}', now(), now(), '{}'
+                FROM workspaces w
+                JOIN services s ON s.ws_id = w.id
+                CROSS JOIN generate_series(0, %(routes)s - 1) AS r
+                WHERE w.name = ANY(%(workspaces)s)"""
+        elif table == "consumers":
+            select = """\
+                SELECT gen_random_uuid(), w.name || '-consumer-' || c, w.id,
+                    w.name || '-consumer-' || c, 0
+                FROM workspaces w
+                CROSS JOIN generate_series(0, %(consumers)s - 1) AS c
+                WHERE w.name = ANY(%(workspaces)s)"""
         else:
-            return {
-                v["id"]: {
-                    "name": v["name"],
-                    "ws_id": v["ws_id"],
-                    "composit": "{}^{}^{}".format(
-                        v["name"], v["service_id"], v["ws_id"]
-                    ),
-                }
-                for v in current.values()
-                if v["ws_id"] in active
-            }
+            select = """\
+                SELECT gen_random_uuid(), %(plugin)s, s.id, %(config)s, true,
+                    'plugins:' || %(plugin)s || '::' || s.id || ':::' || s.ws_id,
+                    '{grpc,grpcs,http,https}', s.ws_id
+                FROM workspaces w
+                JOIN services s ON s.ws_id = w.id
+                WHERE w.name = ANY(%(workspaces)s)"""
+        return """\
+            INSERT INTO {} ({})
+            {}
+            ON CONFLICT DO NOTHING;""".format(
+            table, self.items_str(self.insert_items[table]), select
+        )
 
-    def consumers_parser(
-        self, current: Dict[str, Any], active: List[str], entity: str
-    ) -> Dict[str, Any]:
-        parsed_data = self.parse_cache[entity]
-        if parsed_data:
-            return parsed_data
+    def generate_params(self) -> Dict[str, Any]:
+        """the values generate_sql is executed with"""
+        return {
+            "workspaces": self.required_workspace_names,
+            "meta": Jsonb({"color": "#3894f0", "thumbnail": None}),
+            "services": self.number_of_services,
+            "routes": self.number_of_routes,
+            "consumers": self.number_of_consumers,
+            "retries": int(self.svc_defaults["retries"]),
+            "protocol": self.svc_defaults["protocol"],
+            "host": self.svc_defaults["host"],
+            "port": int(self.svc_defaults["port"]),
+            "path": self.svc_defaults["path"],
+            "connect_timeout": int(self.svc_defaults["connect_timeout"]),
+            "write_timeout": int(self.svc_defaults["write_timeout"]),
+            "read_timeout": int(self.svc_defaults["read_timeout"]),
+            "path_prefix": self.route_path_prefix,
+            "path_suffix": self.route_path_suffix,
+        }
+
+    def generate_into_table(self, table: str) -> None:
+        """Create the missing rows of table with set based SQL, no row data is sent"""
+        count = 0
+        params: Dict[str, Any] = self.generate_params()
+        with self.metrics.phase(table, "generate"), self.session.cursor() as cursor:
+            if table == "plugins":
+                for name in self.service_plugins:
+                    params.update(
+                        plugin=name, config=Jsonb(self.plugins[name]["config"])
+                    )
+                    cursor.execute(self.generate_sql(table), params)
+                    count += cursor.rowcount
+            else:
+                cursor.execute(self.generate_sql(table), params)
+                count += cursor.rowcount
+        self.metrics.add(table, "rows_written", count)
+        print("{} created: {}".format(table, count))
+        self.created[table] = self.created.get(table, 0) + count
+
+    def scoped_plugin_sql(self, scope: str) -> sql.Composed:
+        """
+        An INSERT ... SELECT that attaches a plugin to a percentage of the
+        services, routes or consumers of every workspace of the run. The nth
+        of them is picked when n * percent / 100 passes a whole number, which
+        spreads the picks evenly and picks the same ones on every run. The
+        cache_key is the one Kong derives, and the id is derived from it, so
+        a rerun, or another database, gets the same rows.
+        """
+        table, column, before, after = self.PLUGIN_SCOPES[scope]
+        if scope == "service":
+            name = "w.name || '-svc-' || (n - 1)"
+        elif scope == "route":
+            name = (
+                "w.name || '-svc-' || (n - 1) / %(routes)s || '-route-' "
+                "|| (n - 1) %% %(routes)s"
+            )
         else:
-            return {
-                v["id"]: {
-                    "username": v["username"],
-                    "composit": "{}^{}".format(v["username"], v["ws_id"]),
-                }
-                for v in current.values()
-                if v["ws_id"] in active
+            name = "w.name || '-consumer-' || (n - 1)"
+        return sql.SQL(
+            """\
+            INSERT INTO plugins ({})
+            SELECT md5(k.cache_key)::uuid, %(plugin)s, k.id, %(config)s, true,
+                k.cache_key, '{{grpc,grpcs,http,https}}', k.ws_id
+            FROM (
+                SELECT e.id, e.ws_id, 'plugins:' || %(plugin)s || {} || e.id
+                    || {} || e.ws_id AS cache_key
+                FROM workspaces w
+                CROSS JOIN generate_series(1, %(size)s) AS n
+                JOIN {} e ON e.ws_id = w.id AND e.{} = {}
+                WHERE w.name = ANY(%(workspaces)s)
+                AND floor(n * %(percent)s / 100) > floor((n - 1) * %(percent)s / 100)
+            ) k
+            ON CONFLICT DO NOTHING;"""
+        ).format(
+            sql.SQL(", ").join(
+                map(
+                    sql.Identifier,
+                    ["id", "name", column, "config", "enabled", "cache_key"]
+                    + ["protocols", "ws_id"],
+                )
+            ),
+            sql.Literal(before),
+            sql.Literal(after),
+            sql.Identifier(table),
+            sql.Identifier("username" if scope == "consumer" else "name"),
+            sql.SQL(name),
+        )
+
+    def scoped_plugin_statements(
+        self,
+    ) -> Iterator[Tuple[str, sql.Composed, Dict[str, Any]]]:
+        """the scope, statement and parameters of each scoped plugin"""
+        for name, scope, percent in self.scoped_plugins:
+            yield scope, self.scoped_plugin_sql(scope), {
+                "plugin": name,
+                "config": Jsonb(self.plugins[name]["config"]),
+                "percent": percent,
+                "size": self.scope_size(scope),
+                "routes": max(self.number_of_routes, 1),
+                "workspaces": self.required_workspace_names,
             }
 
-    def plugins_parser(
-        self, current: Dict[str, Any], active: List[str], entity: str
-    ) -> Dict[str, Any]:
-        parsed_data = self.parse_cache[entity]
-        if parsed_data:
-            return parsed_data
+    def create_scoped_plugins(self) -> None:
+        """
+        Attach the plugins the config scopes to routes, consumers or only
+        some of the services, with one set based INSERT per plugin and
+        scope, so none of their rows is built in Python
+        """
+        counts: Dict[str, int] = {}
+        with self.metrics.phase("plugins", "generate"):
+            with self.session.stage("scoped_plugins") as conn, conn.cursor() as cursor:
+                for scope, statement, params in self.scoped_plugin_statements():
+                    cursor.execute(statement, params)
+                    counts[scope] = counts.get(scope, 0) + cursor.rowcount
+        for scope, count in counts.items():
+            print(
+                "plugins created on {}: {}".format(self.PLUGIN_SCOPES[scope][0], count)
+            )
+        self.metrics.add("plugins", "rows_written", sum(counts.values()))
+        self.created["plugins"] = self.created.get("plugins", 0) + sum(counts.values())
+
+    def drop_indexes(self, table: str) -> List[str]:
+        """
+        Drop the indexes of table that do not back a constraint, returning
+        the statements that recreate them
+        """
+        with self.metrics.phase(table, "index"), self.session.cursor() as cursor:
+            cursor.execute(
+                """\
+                SELECT i.relname, pg_get_indexdef(x.indexrelid) FROM pg_index x
+                JOIN pg_class i ON i.oid = x.indexrelid
+                WHERE x.indrelid = %s::regclass
+                AND NOT EXISTS (
+                    SELECT 1 FROM pg_constraint c WHERE c.conindid = x.indexrelid
+                );""",
+                (table,),
+            )
+            indexes = cursor.fetchall()
+            for name, _ in indexes:
+                cursor.execute(sql.SQL("DROP INDEX {};").format(sql.Identifier(name)))
+        print("{} indexes dropped: {}".format(table, len(indexes)))
+        return [definition for _, definition in indexes]
+
+    def create_indexes(self, table: str, indexes: List[str]) -> None:
+        if not indexes:
+            return
+        with self.metrics.phase(table, "index"), self.session.cursor() as cursor:
+            for definition in indexes:
+                cursor.execute(definition)
+
+    def analyze_tables(self, tables: List[str]) -> None:
+        with self.session.cursor() as cursor:
+            for table in tables:
+                with self.metrics.phase(table, "analyze"):
+                    cursor.execute(sql.SQL("ANALYZE {};").format(sql.Identifier(table)))
+        print("analyzed: {}".format(", ".join(tables)))
+
+    def copy_sql(self, target: str, items: List[str]) -> str:
+        return "COPY {} ({}) FROM STDIN{}".format(
+            target,
+            self.items_str(items),
+            " (FORMAT BINARY)" if self.copy_format == "binary" else "",
+        )
+
+    def copy_rows(
+        self,
+        table: str,
+        items: List[str],
+        data: Iterable[Tuple[Any, ...]],
+        written: Optional[EntityStore] = None,
+        stats: Optional[Dict[str, float]] = None,
+    ) -> int:
+        """
+        COPY data into table, through a staging table with bulk_load,
+        returning how many rows were sent. When written is given the rows
+        are added to it. When stats is given the seconds the server took
+        once the last row was sent are recorded in it as "server".
+        """
+        get_items: List[str] = self.get_items[table]
+        cached: List[int] = [items.index(i) for i in get_items]
+        count = 0
+        types: List[int] = self.get_column_types(table, items)
+        target: str = "staging_{}".format(table) if self.bulk_load else table
+        with self.session.cursor() as cursor:
+            if self.bulk_load:
+                cursor.execute(
+                    "CREATE TEMP TABLE {} (LIKE {} INCLUDING DEFAULTS);".format(
+                        target, table
+                    )
+                )
+            with cursor.copy(self.copy_sql(target, items)) as copy:
+                copy.set_types(types)
+                self.metrics.watch_copy(table, copy)
+                for record in self.metrics.stream(table, data, progress=stats is None):
+                    copy.write_row(record)
+                    count += 1
+                    if written is not None:
+                        written.add(*[record[i] for i in cached])
+                sent = time.perf_counter()
+            if self.bulk_load:
+                with self.metrics.phase(table, "copy"):
+                    cursor.execute(
+                        "INSERT INTO {0} ({1}) SELECT {1} FROM {2};".format(
+                            table, self.items_str(items), target
+                        )
+                    )
+                    cursor.execute("DROP TABLE {};".format(target))
+        if stats is not None:
+            stats["server"] = time.perf_counter() - sent
+        return count
+
+    def copy_in_batches(
+        self,
+        table: str,
+        items: List[str],
+        data: Iterable[Tuple[Any, ...]],
+        written: Optional[EntityStore] = None,
+    ) -> int:
+        """
+        COPY data into table in batches, each committed on its own, sized
+        by a BatchSizer from the rows/sec of the batches before it. Every
+        batch's rows, time and server latency (from its last row being sent
+        to its commit returning) are appended to batch_log. Returns how many
+        rows were sent.
+        """
+        sizer = BatchSizer(
+            self.batch_size or self.DEFAULT_BATCH_SIZE, self.target_commit_ms
+        )
+        rows = iter(data)
+        count = 0
+        sizes: List[int] = []
+        commits: List[float] = []
+        log = open(self.batch_log, "a") if self.batch_log else None
+        try:
+            while True:
+                size = sizer.size
+                stats: Dict[str, float] = {}
+                start = time.perf_counter()
+                with self.session.stage(table):
+                    sent = self.copy_rows(
+                        table, items, islice(rows, size), written, stats
+                    )
+                    committing = time.perf_counter()
+                end = time.perf_counter()
+                if not sent:
+                    break
+                seconds = end - start
+                server = stats["server"] + end - committing
+                count += sent
+                sizes.append(sent)
+                commits.append(seconds)
+                sizer.update(sent, seconds)
+                if log is not None:
+                    log.write(
+                        json.dumps(
+                            {
+                                "entity": table,
+                                "batch": len(sizes),
+                                "rows": sent,
+                                "seconds": round(seconds, 4),
+                                "rows_per_sec": round(sent / seconds),
+                                "server_ms": round(server * 1000, 1),
+                                "next_size": sizer.size,
+                            }
+                        )
+                        + "\n"
+                    )
+                print(
+                    "{} creating: {} (batch of {} in {:.0f}ms, server {:.0f}ms)".format(
+                        table, count, sent, seconds * 1000, server * 1000
+                    ),
+                    end="\r",
+                )
+                if sent < size:
+                    break
+        finally:
+            if log is not None:
+                log.close()
+        if sizes:
+            print(
+                "{} batches: {}, {}-{} rows, median commit {:.0f}ms".format(
+                    table,
+                    len(sizes),
+                    min(sizes),
+                    max(sizes),
+                    sorted(commits)[len(commits) // 2] * 1000,
+                )
+                + " " * 20
+            )
+        return count
+
+    def insert_into_table(
+        self, table: str, items: List[str], data: Iterable[Tuple[Any, ...]]
+    ) -> None:
+        written = EntityStore.for_table(table)
+        cache = table in self.CACHED_TABLES and not (
+            self.refresh or self.deterministic_ids
+        )
+        if self.batching:
+            count = self.copy_in_batches(table, items, data, written if cache else None)
         else:
-            return {
-                v["id"]: {
-                    "name": v["name"],
-                    "composit": "{}^{}^{}".format(
-                        v["name"], v["service_id"], v["ws_id"]
+            count = self.copy_rows(table, items, data, written if cache else None)
+        print("{} created: {}".format(table, count) + " " * 20)
+        self.created[table] = self.created.get(table, 0) + count
+        if table not in self.CACHED_TABLES:
+            self.clear_cache(table)
+        elif self.refresh:
+            self.refresh_cache(table)
+        elif cache:
+            self.cache_rows(table, written)
+
+    def load_ids(self, cursor: psycopg.Cursor, ids: Iterable[Any]) -> int:
+        """COPY ids into the session's ids temp table, returning how many"""
+        count = 0
+        cursor.execute("CREATE TEMP TABLE IF NOT EXISTS import_ids (id uuid);")
+        cursor.execute("TRUNCATE import_ids;")
+        with cursor.copy("COPY import_ids (id) FROM STDIN;") as copy:
+            for id_ in ids:
+                copy.write_row((id_,))
+                count += 1
+        return count
+
+    def get_existing_ids(self, table: str, ids: Iterable[Any]) -> Set[uuid.UUID]:
+        """the subset of ids that are present in table, found with a join"""
+        with self.metrics.phase(table, "read"), self.session.cursor() as cursor:
+            self.load_ids(cursor, ids)
+            cursor.execute(
+                "SELECT t.id FROM {} t JOIN import_ids d ON d.id = t.id;".format(table)
+            )
+            existing = {row[0] for row in cursor.fetchall()}
+        self.metrics.add(table, "rows_read", len(existing))
+        return existing
+
+    def delete_in_batches(self, table: str, column: str, ws_ids: List[str]) -> int:
+        """
+        Delete the rows of table whose column is one of ws_ids, entirely on
+        the server. The ids are numbered into a temp table once, then deleted
+        in ranges of delete_batch_size rows, each range in its own stage so
+        locks and WAL stay bounded.
+        """
+        start = time.perf_counter()
+        with self.metrics.phase(table, "delete"), self.session.cursor() as cursor:
+            cursor.execute("DROP TABLE IF EXISTS delete_ids;")
+            cursor.execute(
+                sql.SQL(
+                    """\
+                    CREATE TEMP TABLE delete_ids AS
+                    SELECT row_number() OVER () AS n, id FROM {}
+                    WHERE {} = ANY(%s::uuid[]);"""
+                ).format(sql.Identifier(table), sql.Identifier(column)),
+                (ws_ids,),
+            )
+            total: int = cursor.rowcount
+            cursor.execute("CREATE INDEX ON delete_ids (n);")
+            cursor.execute("ANALYZE delete_ids;")
+            deleted = 0
+            for first in range(0, total, self.delete_batch_size):
+                with self.session.stage("delete_batch"):
+                    cursor.execute(
+                        sql.SQL(
+                            """\
+                            DELETE FROM {} t USING delete_ids d
+                            WHERE d.n > %s AND d.n <= %s AND t.id = d.id;"""
+                        ).format(sql.Identifier(table)),
+                        (first, first + self.delete_batch_size),
+                        # a generic plan for the range is far slower than a
+                        # custom one, so never let psycopg prepare it
+                        prepare=False,
+                    )
+                    deleted += cursor.rowcount
+                elapsed = time.perf_counter() - start
+                print(
+                    "{} deleted: {}/{} ({:.0f} rows/sec)".format(
+                        table, deleted, total, deleted / elapsed
                     ),
-                }
-                for v in current.values()
-                if v["ws_id"] in active
-            }
+                    end="\r",
+                )
+            cursor.execute("DROP TABLE delete_ids;")
+        self.metrics.add(table, "rows_deleted", deleted)
+        print("{} deleted: {}/{}".format(table, deleted, total) + " " * 20)
+        return deleted
+
+    ################ Verify functions #############################
+
+    def expected_counts(self) -> Dict[str, int]:
+        """the rows of each entity type the config asks for, per workspace"""
+        return {
+            "services": self.number_of_services,
+            "routes": self.number_of_services * self.number_of_routes,
+            "consumers": self.number_of_consumers,
+            "plugins": self.number_of_services * len(self.service_plugins)
+            + sum(self.scoped_count(s, p) for _, s, p in self.scoped_plugins),
+        }
+
+    def expected_plugins(self) -> Dict[Tuple[str, str], int]:
+        """the plugins of each name and scope the config asks for, per workspace"""
+        expected: Dict[Tuple[str, str], int] = {
+            (name, "service"): self.number_of_services for name in self.service_plugins
+        }
+        for name, scope, percent in self.scoped_plugins:
+            expected[name, scope] = self.scoped_count(scope, percent)
+        return expected
+
+    def verify_counts(
+        self, table: str, ws_ids: List[str]
+    ) -> Dict[str, Tuple[int, int, int]]:
+        """
+        Count the rows of table in each of the workspaces ws_ids with one
+        grouped query, along with the rows whose service_id is not a service
+        of their workspace and, for plugins, the rows whose cache_key is not
+        the one Kong derives from the row
+        """
+        join = sql.SQL("")
+        orphans = sql.SQL("0")
+        bad_keys = sql.SQL("0")
+        if table in ("routes", "plugins"):
+            join = sql.SQL(
+                "LEFT JOIN services s ON s.id = t.service_id AND s.ws_id = t.ws_id"
+            )
+            orphans = sql.SQL(
+                "count(*) FILTER (WHERE t.service_id IS NOT NULL AND s.id IS NULL)"
+            )
+        if table == "plugins":
+            bad_keys = sql.SQL(
+                """count(*) FILTER (WHERE t.cache_key IS DISTINCT FROM
+                    'plugins:' || t.name || ':' || coalesce(t.route_id::text, '')
+                    || ':' || coalesce(t.service_id::text, '') || ':'
+                    || coalesce(t.consumer_id::text, '') || '::' || t.ws_id)"""
+            )
+        with self.metrics.phase(table, "verify"), self.session.cursor() as cursor:
+            cursor.execute(
+                sql.SQL(
+                    """\
+                    SELECT t.ws_id, count(*), {}, {} FROM {} t {}
+                    WHERE t.ws_id = ANY(%s::uuid[]) GROUP BY t.ws_id;"""
+                ).format(orphans, bad_keys, sql.Identifier(table), join),
+                (ws_ids,),
+            )
+            return {str(row[0]): tuple(row[1:]) for row in cursor.fetchall()}
+
+    def verify_workspace(self, table: str, ws_name: str, ws_id: str) -> List[str]:
+        """
+        Find where one workspace's rows of table differ from the config: the
+        services or consumers that are missing, or the services with the
+        wrong number of routes or plugins
+        """
+        examples: List[str] = []
+        with self.metrics.phase(table, "verify"), self.session.cursor() as cursor:
+            if table in ("services", "consumers"):
+                column = "name" if table == "services" else "username"
+                kind = "svc" if table == "services" else "consumer"
+                count = self.expected_counts()[table]
+                cursor.execute(
+                    sql.SQL(
+                        """\
+                        SELECT n FROM unnest(%s::text[]) AS n
+                        EXCEPT SELECT {} FROM {} WHERE ws_id = %s
+                        ORDER BY 1;"""
+                    ).format(sql.Identifier(column), sql.Identifier(table)),
+                    (
+                        ["{}-{}-{}".format(ws_name, kind, i) for i in range(count)],
+                        ws_id,
+                    ),
+                )
+                for (name,) in cursor.fetchall():
+                    examples.append("{} is missing".format(name))
+            else:
+                match = sql.SQL("")
+                count = self.number_of_routes
+                if table == "plugins":
+                    examples.extend(self.verify_plugin_scopes(cursor, ws_id))
+                    match = sql.SQL(" AND t.name = ANY(%s::text[])")
+                    count = len(self.service_plugins)
+                cursor.execute(
+                    sql.SQL(
+                        """\
+                        SELECT s.name, count(t.id) FROM services s
+                        LEFT JOIN {} t ON t.service_id = s.id AND t.ws_id = s.ws_id{}
+                        WHERE s.ws_id = %s GROUP BY s.id, s.name
+                        HAVING count(t.id) <> %s ORDER BY 1;"""
+                    ).format(sql.Identifier(table), match),
+                    ([self.service_plugins] if table == "plugins" else [])
+                    + [ws_id, count],
+                )
+                for name, found in cursor.fetchall():
+                    examples.append(
+                        "service {} has {} {}, expected {}".format(
+                            name, found, table, count
+                        )
+                    )
+                cursor.execute(
+                    "SELECT count(*) FROM services WHERE ws_id = %s;", (ws_id,)
+                )
+                services: int = cursor.fetchone()[0]
+                if services < self.number_of_services:
+                    examples.append(
+                        "{} service(s) are missing, with their {}".format(
+                            self.number_of_services - services, table
+                        )
+                    )
+        return examples
+
+    def verify_plugin_scopes(self, cursor: psycopg.Cursor, ws_id: str) -> List[str]:
+        """
+        Compare the plugins of one workspace of each name and scope with the
+        number the config asks for
+        """
+        cursor.execute(
+            """\
+            SELECT name, CASE WHEN route_id IS NOT NULL THEN 'route'
+                WHEN consumer_id IS NOT NULL THEN 'consumer' ELSE 'service' END,
+                count(*)
+            FROM plugins WHERE ws_id = %s GROUP BY 1, 2;""",
+            (ws_id,),
+        )
+        found: Dict[Tuple[str, str], int] = {
+            (name, scope): count for name, scope, count in cursor.fetchall()
+        }
+        examples: List[str] = []
+        expected = self.expected_plugins()
+        for name, scope in sorted(set(expected) | set(found)):
+            count = found.get((name, scope), 0)
+            if count != expected.get((name, scope), 0):
+                examples.append(
+                    "{} {} plugin(s) on {}, expected {}".format(
+                        count,
+                        name,
+                        self.PLUGIN_SCOPES[scope][0],
+                        expected.get((name, scope), 0),
+                    )
+                )
+        return examples
+
+    def verify_entities(self) -> bool:
+        """
+        Check that every workspace holds the number of each entity type the
+        config asks for, with a grouped count per table, and drill down into
+        the workspaces whose counts are off. Routes and plugins must belong
+        to a service of their workspace and plugins must have the cache_key
+        Kong would give them. Nothing is read row by row unless a workspace
+        is off, so the check takes seconds however large the estate is.
+        """
+        problems = 0
+        try:
+            with self.session.run():
+                workspaces: Dict[str, str] = dict(self.active_workspaces())
+                missing = [
+                    n for n in self.required_workspace_names if n not in workspaces
+                ]
+                print(
+                    "workspaces: {}/{}".format(
+                        len(workspaces), len(self.required_workspace_names)
+                    )
+                )
+                for name in missing:
+                    print("  {} is missing".format(name))
+                problems += len(missing)
+                names: Dict[str, str] = {v: k for k, v in workspaces.items()}
+                for table, expected in self.expected_counts().items():
+                    counts = self.verify_counts(table, list(names))
+                    found = sum(c[0] for c in counts.values())
+                    off = [
+                        ws_id
+                        for ws_id in names
+                        if counts.get(ws_id, (0, 0, 0))[0] != expected
+                    ]
+                    print(
+                        "{}: {}/{} in {} workspace(s){}".format(
+                            table,
+                            found,
+                            expected * len(self.required_workspace_names),
+                            len(names),
+                            ", {} off".format(len(off)) if off else "",
+                        )
+                    )
+                    problems += len(off)
+                    for ws_id in off:
+                        print(
+                            "  {}: {}/{}".format(
+                                names[ws_id], counts.get(ws_id, (0,))[0], expected
+                            )
+                        )
+                        examples = self.verify_workspace(table, names[ws_id], ws_id)
+                        for example in examples[: self.VERIFY_EXAMPLES]:
+                            print("    " + example)
+                        if len(examples) > self.VERIFY_EXAMPLES:
+                            print(
+                                "    and {} more".format(
+                                    len(examples) - self.VERIFY_EXAMPLES
+                                )
+                            )
+                    for ws_id, (_, orphans, bad_keys) in counts.items():
+                        if orphans:
+                            print(
+                                "  {}: {} {} with a service_id that is not a "
+                                "service of the workspace".format(
+                                    names[ws_id], orphans, table
+                                )
+                            )
+                        if bad_keys:
+                            print(
+                                "  {}: {} {} with a cache_key other than "
+                                "plugins:<name>:<route_id>:<service_id>:"
+                                "<consumer_id>::<ws_id>".format(
+                                    names[ws_id], bad_keys, table
+                                )
+                            )
+                        problems += orphans + bad_keys
+        finally:
+            self.report_metrics()
+        self.verified = not problems
+        print(
+            "verified, the database matches the config"
+            if self.verified
+            else "verify found {} problem(s)".format(problems)
+        )
+        return self.verified
+
+    ################ Update functions #############################
+
+    def desired_rows(self, table: str) -> Tuple[List[str], List[Tuple[Any, ...]]]:
+        """
+        The columns and rows staged to update table with: the values of its
+        UPDATE_COLUMNS a create writes, taken from a hydrated row so the two
+        never disagree. Every service and route gets the same values, so
+        they stage one row, and plugins one per name. A route's path is
+        built from its name, so routes stage the prefix and suffix instead.
+        """
+        nil = str(uuid.UUID(int=0))
+        if table == "plugins":
+            keys: List[Tuple[str, ...]] = [(name, nil, nil) for name in self.plugins]
+        elif table == "routes":
+            keys = [("", nil, nil)]
+        else:
+            keys = [("", nil)]
+        items: List[str] = self.insert_items[table]
+        columns: List[str] = [c for c in self.UPDATE_COLUMNS[table] if c != "paths"]
+        rows: List[Tuple[Any, ...]] = [
+            tuple(row[items.index(c)] for c in columns)
+            for row in map(self.entity_data_hydrate[table], keys)
+        ]
+        if table == "plugins":
+            columns = ["name"] + columns
+            rows = [(key[0],) + row for key, row in zip(keys, rows)]
+        elif table == "routes":
+            columns += ["path_prefix", "path_suffix"]
+            rows = [
+                row + (self.route_path_prefix, self.route_path_suffix) for row in rows
+            ]
+        return columns, rows
+
+    def update_table(self, table: str, ws_ids: List[str]) -> int:
+        """
+        COPY the desired_rows of table into the temp table desired_<table>,
+        then bring the rows of the config's workspaces in line with them in
+        one UPDATE ... FROM, which only touches the rows with a column that
+        differs. Returns how many rows it changed.
+        """
+        columns, rows = self.desired_rows(table)
+        staged = sql.Identifier("desired_{}".format(table))
+        values: Dict[str, sql.Composable] = {
+            c: sql.SQL("d.{}").format(sql.Identifier(c))
+            for c in self.UPDATE_COLUMNS[table]
+        }
+        match = sql.SQL("")
+        if table == "routes":
+            values["paths"] = sql.SQL("ARRAY[d.path_prefix || t.name || d.path_suffix]")
+        elif table == "plugins":
+            match = sql.SQL(" AND t.name = d.name")
+        change = sql.SQL(", ").join(
+            sql.SQL("{} = {}").format(sql.Identifier(c), v) for c, v in values.items()
+        )
+        if "updated_at" in self.table_columns(table):
+            change = sql.SQL("{}, updated_at = CURRENT_TIMESTAMP(0)").format(change)
+        copied = [c for c in columns if c not in ("path_prefix", "path_suffix")]
+        with self.metrics.phase(table, "update"), self.session.stage(table) as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(sql.SQL("DROP TABLE IF EXISTS {};").format(staged))
+                cursor.execute(
+                    sql.SQL(
+                        "CREATE TEMP TABLE {} AS SELECT {} FROM {} WITH NO DATA;"
+                    ).format(
+                        staged,
+                        sql.SQL(", ").join(map(sql.Identifier, copied)),
+                        sql.Identifier(table),
+                    )
+                )
+                if table == "routes":
+                    cursor.execute(
+                        sql.SQL(
+                            "ALTER TABLE {} ADD path_prefix text, ADD path_suffix text;"
+                        ).format(staged)
+                    )
+                with cursor.copy(
+                    sql.SQL("COPY {} ({}) FROM STDIN").format(
+                        staged, sql.SQL(", ").join(map(sql.Identifier, columns))
+                    )
+                ) as copy:
+                    for row in rows:
+                        copy.write_row(row)
+                cursor.execute(sql.SQL("ANALYZE {};").format(staged))
+                cursor.execute(
+                    sql.SQL(
+                        """\
+                        UPDATE {} t SET {} FROM {} d
+                        WHERE t.ws_id = ANY(%s::uuid[]){}
+                        AND ({}) IS DISTINCT FROM ({});"""
+                    ).format(
+                        sql.Identifier(table),
+                        change,
+                        staged,
+                        match,
+                        sql.SQL(", ").join(
+                            sql.SQL("t.{}").format(sql.Identifier(c)) for c in values
+                        ),
+                        sql.SQL(", ").join(values.values()),
+                    ),
+                    (ws_ids,),
+                )
+                count: int = cursor.rowcount
+                cursor.execute(sql.SQL("DROP TABLE {};").format(staged))
+        self.metrics.add(table, "rows_updated", count)
+        return count
+
+    def update_entities(self) -> None:
+        """
+        Bring the services, routes and plugins that already exist in the
+        config's workspaces in line with the config file, one set based
+        UPDATE per table, without creating or deleting anything
+        """
+        try:
+            with self.session.run():
+                ws_ids: List[str] = list(self.get_active_filter("services"))
+                for table in self.UPDATE_COLUMNS:
+                    if table not in self.update:
+                        continue
+                    start = time.perf_counter()
+                    count = self.update_table(table, ws_ids)
+                    print(
+                        "{}: updated {} rows in {:.2f}s".format(
+                            table, count, time.perf_counter() - start
+                        )
+                    )
+                    self.metrics.record_rss(table)
+        finally:
+            self.report_metrics()
+
+    ################ Churn functions ##############################
+
+    def plugin_churn_fields(self) -> Dict[str, Tuple[str, Any, Any]]:
+        """
+        The config field churn flips for each plugin of the config, with its
+        value and the value it is flipped to: the first boolean field, negated,
+        or failing that the first integer field, plus one. Plugins with
+        neither are not churned, so every config written is one Kong accepts.
+        """
+        fields: Dict[str, Tuple[str, Any, Any]] = {}
+        for name, plugin in self.plugins.items():
+            config: Dict[str, Any] = plugin["config"] or {}
+            flags = [(k, v, not v) for k, v in config.items() if isinstance(v, bool)]
+            numbers = [
+                (k, v, v + 1)
+                for k, v in config.items()
+                if isinstance(v, int) and not isinstance(v, bool)
+            ]
+            if flags or numbers:
+                fields[name] = (flags + numbers)[0]
+        return fields
+
+    def churn_targets(self, churn_type: str, ws_ids: List[str]) -> int:
+        """
+        Number churn_percent of the rows of the config's workspaces that
+        churn_type updates, picked at random, into the temp table
+        churn_<table>, returning how many there are
+        """
+        table: str = self.CHURN_TYPES[churn_type]
+        where = sql.SQL("ws_id = ANY(%s::uuid[])")
+        params: List[Any] = [ws_ids]
+        if churn_type == "plugin_configs":
+            where = sql.SQL("{} AND name = ANY(%s::text[])").format(where)
+            params.append(list(self.plugin_churn_fields()))
+        with self.metrics.phase(table, "read"), self.session.cursor() as cursor:
+            cursor.execute(
+                sql.SQL("SELECT count(*) FROM {} WHERE {};").format(
+                    sql.Identifier(table), where
+                ),
+                params,
+            )
+            total: int = cursor.fetchone()[0]
+            target = sql.Identifier("churn_{}".format(table))
+            cursor.execute(sql.SQL("DROP TABLE IF EXISTS {};").format(target))
+            cursor.execute(
+                sql.SQL(
+                    """\
+                    CREATE TEMP TABLE {} AS
+                    SELECT row_number() OVER () AS n, id FROM (
+                        SELECT id FROM {} WHERE {} ORDER BY random() LIMIT %s
+                    ) s;"""
+                ).format(target, sql.Identifier(table), where),
+                params + [math.ceil(total * self.churn_percent / 100)],
+            )
+            count: int = cursor.rowcount
+            cursor.execute(sql.SQL("CREATE INDEX ON {} (n);").format(target))
+            cursor.execute(sql.SQL("ANALYZE {};").format(target))
+        self.metrics.add(table, "rows_read", count)
+        return count
+
+    def churn_statement(self, churn_type: str) -> Tuple[sql.Composed, List[Any]]:
+        """
+        The UPDATE that churns the rows numbered from %s (exclusive) to %s
+        of churn_<table>, with the parameters that come before that range.
+        Every kind of churn changes its rows each time it runs: retries
+        cycle from 1 to 10, routes gain a second path or lose it again and
+        plugins flip their plugin_churn_fields field. updated_at is bumped
+        where the table has it.
+        """
+        table: str = self.CHURN_TYPES[churn_type]
+        params: List[Any] = []
+        from_ = sql.SQL("")
+        match = sql.SQL("")
+        if churn_type == "service_retries":
+            change = sql.SQL("retries = coalesce(t.retries, 5) %% 10 + 1")
+        elif churn_type == "route_paths":
+            change = sql.SQL(
+                "paths = CASE WHEN cardinality(t.paths) > 1 THEN t.paths[1:1] "
+                "ELSE t.paths || ('/churn-' || t.name) END"
+            )
+        else:
+            change = sql.SQL(
+                "config = jsonb_set(t.config, ARRAY[f.field], CASE WHEN "
+                "t.config -> f.field = f.value THEN f.flipped ELSE f.value END)"
+            )
+            from_ = sql.SQL(
+                ", unnest(%s::text[], %s::text[], %s::jsonb[], %s::jsonb[]) "
+                "AS f(name, field, value, flipped)"
+            )
+            match = sql.SQL(" AND f.name = t.name")
+            fields = self.plugin_churn_fields()
+            params = [
+                list(fields),
+                [field for field, _, _ in fields.values()],
+                [json.dumps(value) for _, value, _ in fields.values()],
+                [json.dumps(flipped) for _, _, flipped in fields.values()],
+            ]
+        if "updated_at" in self.table_columns(table):
+            change = sql.SQL("{}, updated_at = CURRENT_TIMESTAMP(0)").format(change)
+        statement = sql.SQL(
+            """\
+            UPDATE {} t SET {} FROM {} d{}
+            WHERE d.n > %s AND d.n <= %s AND t.id = d.id{};"""
+        ).format(
+            sql.Identifier(table),
+            change,
+            sql.Identifier("churn_{}".format(table)),
+            from_,
+            match,
+        )
+        return statement, params
+
+    def churn_batches(self, targets: Dict[str, int]) -> int:
+        """
+        Update the rows numbered in each churn_<table>, a batch of at most
+        churn_batch_size rows per transaction, taking turns between the
+        kinds of churn and starting again from the first row once the last
+        one was updated. Batches are spaced out to keep to churn_rate, and
+        shrunk to it so there is at least one a second. Runs for
+        churn_duration seconds, or until interrupted, and returns how many
+        rows were updated.
+        """
+        statements = {t: self.churn_statement(t) for t in targets}
+        batch = self.churn_batch_size
+        if self.churn_rate:
+            batch = min(batch, max(int(self.churn_rate), 1))
+        offsets: Dict[str, int] = dict.fromkeys(targets, 0)
+        types = cycle(list(targets))
+        churn_type = next(types)
+        updated = 0
+        start = last = time.perf_counter()
+        elapsed = 0.0
+        try:
+            with self.session.cursor() as cursor:
+                while not self.churn_duration or elapsed < self.churn_duration:
+                    wait = updated / self.churn_rate - elapsed if self.churn_rate else 0
+                    if wait > 0:
+                        if self.churn_duration:
+                            wait = min(wait, self.churn_duration - elapsed)
+                        time.sleep(wait)
+                        elapsed = time.perf_counter() - start
+                        continue
+                    table: str = self.CHURN_TYPES[churn_type]
+                    statement, params = statements[churn_type]
+                    first = offsets[churn_type]
+                    end = min(first + batch, targets[churn_type])
+                    with self.metrics.phase(table, "churn"):
+                        with self.session.stage("churn_batch"):
+                            cursor.execute(
+                                statement, params + [first, end], prepare=False
+                            )
+                    offsets[churn_type] = end % targets[churn_type]
+                    updated += cursor.rowcount
+                    self.metrics.add(table, "rows_updated", cursor.rowcount)
+                    churn_type = next(types)
+                    now = time.perf_counter()
+                    elapsed = now - start
+                    if now - last > 0.5:
+                        last = now
+                        print(
+                            "churned: {} ({:.0f} updates/sec)".format(
+                                updated, updated / elapsed
+                            ),
+                            end="\r",
+                        )
+        except KeyboardInterrupt:
+            elapsed = time.perf_counter() - start
+        print(
+            "churned {} rows in {:.2f}s ({:.0f} updates/sec, target {})".format(
+                updated,
+                elapsed,
+                updated / elapsed if elapsed else 0,
+                "{:g}/sec".format(self.churn_rate) if self.churn_rate else "none",
+            )
+            + " " * 20
+        )
+        return updated
+
+    def churn_entities(self) -> None:
+        """
+        Pick churn_percent of the entities each kind of churn updates, then
+        update them over and over in batches, the way config changes made
+        through the Admin API would, to stress how Kong propagates them
+        """
+        try:
+            with self.session.run():
+                ws_ids: List[str] = list(self.get_active_filter("services"))
+                targets: Dict[str, int] = {}
+                for churn_type in self.churn:
+                    count = self.churn_targets(churn_type, ws_ids)
+                    print(
+                        "{}: churning {} {}".format(
+                            churn_type, count, self.CHURN_TYPES[churn_type]
+                        )
+                    )
+                    if count:
+                        targets[churn_type] = count
+                if targets:
+                    self.churn_batches(targets)
+                else:
+                    print("nothing to churn")
+                for churn_type in targets:
+                    self.metrics.record_rss(self.CHURN_TYPES[churn_type])
+        finally:
+            self.report_metrics()
+
+    ################ Async functions ##############################
+
+    def new_id(self, entity: str, name: str) -> uuid.UUID:
+        if self.deterministic_ids:
+            return deterministic_id(entity, name)
+        return next(self.random_ids)
+
+    def workspace_keys(
+        self, entity: str, ws_name: str, ws_id: str, services: Dict[str, str]
+    ) -> Iterator[Tuple[str, Tuple[str, ...]]]:
+        """
+        Yield the name its id is derived from and the key of every entity of
+        this type one workspace needs. services maps the ids of the
+        workspace's services to their names.
+        """
+        if entity == "services":
+            for i in range(self.number_of_services):
+                name = "{}-svc-{}".format(ws_name, i)
+                yield name, (name, ws_id)
+        elif entity == "consumers":
+            for i in range(self.number_of_consumers):
+                name = "{}-consumer-{}".format(ws_name, i)
+                yield name, (name, ws_id)
+        elif entity == "routes":
+            for svc_id, svc_name in services.items():
+                for r in range(self.number_of_routes):
+                    name = "{}-route-{}".format(svc_name, r)
+                    yield name, (name, svc_id, ws_id)
+        elif entity == "plugins":
+            for svc_id, svc_name in services.items():
+                for p in self.service_plugins:
+                    yield "{}:{}".format(p, svc_name), (p, svc_id, ws_id)
+
+    def workspace_missing(
+        self,
+        entity: str,
+        ws_name: str,
+        ws_id: str,
+        services: Dict[str, str],
+        loaded: Optional[Dict[str, str]],
+        existing: Optional[EntityStore] = None,
+    ) -> Iterator[Tuple[Tuple[str, ...], uuid.UUID]]:
+        """
+        Yield the key and new id of every entity of this type one workspace
+        is missing from existing, the entity type's store by default. When loaded
+        is given, the id and name of every entity the workspace has once the
+        rows are written, existing or new, are recorded in it.
+        """
+        if existing is None:
+            existing = self.get_active_entities_data(entity)
+        required = self.metrics.count(
+            entity,
+            "rows_diffed",
+            self.workspace_keys(entity, ws_name, ws_id, services),
+        )
+        for name, key in required:
+            id_ = existing.get(key)
+            if id_ is None:
+                new_id = self.new_id(entity, name)
+                id_ = str(new_id)
+                yield key, new_id
+            if loaded is not None:
+                loaded[id_] = key[0]
+
+    async def connect_async(
+        self, conninfo: Optional[str] = None
+    ) -> psycopg.AsyncConnection:
+        start = time.perf_counter()
+        conn = await psycopg.AsyncConnection.connect(
+            conninfo or self.session.conninfo, autocommit=True
+        )
+        self.metrics.connect_seconds += time.perf_counter() - start
+        self.metrics.connections += 1
+        return conn
+
+    async def copy_rows_async(
+        self,
+        conn: psycopg.AsyncConnection,
+        table: str,
+        data: Iterable[Tuple[Any, ...]],
+    ) -> int:
+        """COPY rows into table in one transaction on conn, returning how many"""
+        items: List[str] = self.insert_items[table]
+        target: str = "staging_{}".format(table) if self.bulk_load else table
+        count = 0
+        async with conn.transaction():
+            async with conn.cursor() as cursor:
+                if self.bulk_load:
+                    await cursor.execute(
+                        "CREATE TEMP TABLE {} (LIKE {} INCLUDING DEFAULTS);".format(
+                            target, table
+                        )
+                    )
+                async with cursor.copy(self.copy_sql(target, items)) as copy:
+                    copy.set_types(self.get_column_types(table, items))
+                    self.metrics.watch_copy(table, copy)
+                    for record in self.metrics.stream(table, data, progress=False):
+                        await copy.write_row(record)
+                        count += 1
+                if self.bulk_load:
+                    await cursor.execute(
+                        "INSERT INTO {0} ({1}) SELECT {1} FROM {2};".format(
+                            table, self.items_str(items), target
+                        )
+                    )
+                    await cursor.execute("DROP TABLE {};".format(target))
+        return count
+
+    async def load_entity_async(
+        self,
+        entity: str,
+        ws_name: str,
+        ws_id: str,
+        parents: List["asyncio.Future[Dict[str, str]]"],
+        connections: "asyncio.Queue[psycopg.AsyncConnection]",
+    ) -> Dict[str, str]:
+        """
+        Wait for the loads entity depends on, then load the workspace's
+        entities of this type over the first free connection. Returns the
+        ids and names of the workspace's entities of this type when another
+        entity type depends on it.
+        """
+        services: Dict[str, str] = {}
+        for loaded in await asyncio.gather(*parents):
+            services.update(loaded)
+        dependents = [e for e, deps in self.DEPENDENCIES.items() if entity in deps]
+        loaded: Optional[Dict[str, str]] = {} if dependents else None
+        rows = self.hydrate_rows(
+            entity, self.workspace_missing(entity, ws_name, ws_id, services, loaded)
+        )
+        conn: psycopg.AsyncConnection = await connections.get()
+        try:
+            count = await self.copy_rows_async(conn, entity, rows)
+        finally:
+            connections.put_nowait(conn)
+        self.created[entity] = self.created.get(entity, 0) + count
+        return loaded or {}
+
+    async def load_workspace_async(
+        self,
+        ws_name: str,
+        ws_id: str,
+        connections: "asyncio.Queue[psycopg.AsyncConnection]",
+    ) -> None:
+        """
+        Schedule a load per entity type of one workspace, each one starting
+        as soon as the loads it depends on (DEPENDENCIES) have finished
+        """
+        tasks: Dict[str, "asyncio.Future[Dict[str, str]]"] = {}
+        for entity in self.entites[1:]:
+            parents = [tasks[d] for d in self.DEPENDENCIES[entity] if d in tasks]
+            tasks[entity] = asyncio.ensure_future(
+                self.load_entity_async(entity, ws_name, ws_id, parents, connections)
+            )
+        await asyncio.gather(*tasks.values())
+
+    async def load_workspaces_async(self, workspaces: List[Tuple[str, str]]) -> None:
+        connections: "asyncio.Queue[psycopg.AsyncConnection]" = asyncio.Queue()
+        conns: List[psycopg.AsyncConnection] = []
+        try:
+            for _ in range(self.concurrency):
+                conn = await self.connect_async()
+                conns.append(conn)
+                connections.put_nowait(conn)
+            await asyncio.gather(
+                *(
+                    self.load_workspace_async(name, id_, connections)
+                    for name, id_ in workspaces
+                )
+            )
+        finally:
+            for conn in conns:
+                await conn.close()
 
-    ################### Helper functions #########################
+    ################ Fan-out functions ############################
 
-    def parse_config(self, config_file) -> Dict[str, Any]:
-        d = {}
-        with open(config_file, "r") as stream:
-            try:
-                d = yaml.safe_load(stream)
-            except yaml.YAMLError as exc:
-                print(exc)
-        return d
+    async def target_copy(
+        self,
+        target: Target,
+        table: str,
+        statement: str,
+        types: Optional[List[int]],
+        queue: "asyncio.Queue[Optional[List[Tuple[Any, ...]]]]",
+        setup: Iterable[str] = (),
+    ) -> Optional[Tuple[int, float]]:
+        """
+        COPY the batches of rows put on queue into one target, in one
+        transaction, until a None is put. Returns how many rows were sent
+        and how long it took, or None if the target failed, in which case
+        the rest of the queue is drained so the rows for the other targets
+        keep flowing.
+        """
+        done = False
+        count = 0
+        start = time.perf_counter()
+        try:
+            async with target.conn.transaction():
+                async with target.conn.cursor() as cursor:
+                    for command in setup:
+                        await cursor.execute(command)
+                    async with cursor.copy(statement) as copy:
+                        if types:
+                            copy.set_types(types)
+                            self.metrics.watch_copy(table, copy)
+                        while not done:
+                            batch = await queue.get()
+                            if batch is None:
+                                done = True
+                                continue
+                            for row in batch:
+                                await copy.write_row(row)
+                            count += len(batch)
+        except Exception as exc:
+            target.fail(table, exc)
+            while not done:
+                done = await queue.get() is None
+            return None
+        return count, time.perf_counter() - start
 
-    def get_svc_defaults(self, data: Dict[str, str]) -> Dict[str, str]:
-        return {
-            "protocol": self.set_param("service_protocol", "http", data),
-            "host": self.set_param("service_host", "httpbin.org", data),
-            "port": self.set_param("service_port", "80", data),
-            "path": self.set_param("service_path", "/", data),
-            "retries": self.set_param("service_retries", "5", data),
-            "connect_timeout": self.set_param("service_connect_timeout", "60000", data),
-            "write_timeout": self.set_param("service_write_timeout", "60000", data),
-            "read_timeout": self.set_param("service_read_timeout", "60000", data),
+    async def fan_out_copy(
+        self,
+        targets: List[Target],
+        table: str,
+        statement: str,
+        types: Optional[List[int]],
+        rows: Iterable[Tuple[Tuple[Any, ...], List[Target]]],
+        setup: Iterable[str] = (),
+    ) -> List[Optional[Tuple[int, float]]]:
+        """
+        COPY rows into every target at once, each over its own connection.
+        rows yields each row once, with the targets it is sent to. It is
+        consumed here, a batch at a time, and each target's COPY runs as
+        its queue fills, so a slow target only holds the others up once
+        its queue is full. Returns what target_copy returned for each target.
+        """
+        queues: Dict[Target, "asyncio.Queue[Optional[List[Tuple[Any, ...]]]]"] = {
+            t: asyncio.Queue(self.FAN_OUT_QUEUE) for t in targets
         }
+        copies = [
+            asyncio.ensure_future(
+                self.target_copy(t, table, statement, types, queues[t], setup)
+            )
+            for t in targets
+        ]
+        batches: Dict[Target, List[Tuple[Any, ...]]] = {t: [] for t in targets}
+        try:
+            for row, to in rows:
+                for target in to:
+                    batch = batches[target]
+                    batch.append(row)
+                    if len(batch) == self.FAN_OUT_BATCH:
+                        batches[target] = []
+                        await queues[target].put(batch)
+            for target in targets:
+                if batches[target]:
+                    await queues[target].put(batches[target])
+                await queues[target].put(None)
+        except BaseException:
+            # never let a COPY commit a part of the rows
+            for copy in copies:
+                copy.cancel()
+            await asyncio.gather(*copies, return_exceptions=True)
+            raise
+        return await asyncio.gather(*copies)
 
-    def set_param(self, value: str, default: str, data: Dict[str, str]) -> str:
-        return data[value] if value in data.keys() else default
+    async def read_existing_ids(self, targets: List[Target], entity: str) -> None:
+        """
+        Find which of the ids the config asks for each target already has.
+        The ids are derived once and streamed to every target's import_ids
+        temp table at once, then joined with the table on each target.
+        """
+        ids = ((id_,) for id_, _ in self.deterministic_keys(entity))
+        with self.metrics.phase(entity, "read"):
+            await self.fan_out_copy(
+                targets,
+                entity,
+                "COPY import_ids (id) FROM STDIN",
+                None,
+                ((row, targets) for row in ids),
+                (
+                    "CREATE TEMP TABLE IF NOT EXISTS import_ids (id uuid);",
+                    "TRUNCATE import_ids;",
+                ),
+            )
+            for target in targets:
+                target.existing = set()
+                if target.error is not None:
+                    continue
+                try:
+                    async with target.conn.cursor() as cursor:
+                        await cursor.execute(
+                            "SELECT t.id FROM {} t "
+                            "JOIN import_ids d ON d.id = t.id;".format(entity)
+                        )
+                        target.existing = {row[0] for row in await cursor.fetchall()}
+                except Exception as exc:
+                    target.fail(entity, exc)
+                self.metrics.add(entity, "rows_read", len(target.existing))
 
-    def db_connect(self, params: Dict[str, str]) -> str:
-        hostname = self.set_param("hostname", "127.0.0.1", params)
-        database = self.set_param("database", "kong", params)
-        username = self.set_param("username", "kong", params)
-        password = self.set_param("password", "kong", params)
-        return "host={} dbname={} user={} password={}".format(
-            hostname, database, username, password
+    def fan_out_rows(
+        self, entity: str, targets: List[Target]
+    ) -> Iterator[Tuple[Tuple[Any, ...], List[Target]]]:
+        """
+        Yield every row of this type that a target is missing, hydrated
+        once, with the targets that are missing it
+        """
+        required = self.metrics.count(
+            entity, "rows_diffed", self.deterministic_keys(entity)
         )
+        hydrate = self.entity_data_hydrate[entity]
+        for id_, key in required:
+            missing = [t for t in targets if t.error is None and id_ not in t.existing]
+            if missing:
+                yield hydrate(key, id_), missing
 
-    def items_str(self, items: List[str]) -> str:
-        return ", ".join(items)
+    async def fan_out_async(self, targets: List[Target]) -> None:
+        """
+        Connect to every target, then create the entity types one after
+        another in all of them at once
+        """
+        for target in targets:
+            try:
+                target.conn = await self.connect_async(target.conninfo)
+            except Exception as exc:
+                target.fail("connect", exc)
+        try:
+            for entity in self.entites:
+                live = [t for t in targets if t.error is None]
+                if not live:
+                    break
+                await self.read_existing_ids(live, entity)
+                live = [t for t in live if t.error is None]
+                items: List[str] = self.insert_items[entity]
+                if entity not in self.column_types:
+                    async with live[0].conn.cursor() as cursor:
+                        await cursor.execute(self.COLUMN_TYPES_SQL, (entity,))
+                        self.column_types[entity] = {
+                            name: int(oid) for name, oid in await cursor.fetchall()
+                        }
+                types = [self.column_types[entity][i] for i in items]
+                rows = self.metrics.stream(
+                    entity, self.fan_out_rows(entity, live), progress=False
+                )
+                results = await self.fan_out_copy(
+                    live, entity, self.copy_sql(entity, items), types, rows
+                )
+                for target, result in zip(live, results):
+                    if result is not None:
+                        target.rows[entity], target.seconds[entity] = result
+                count = self.metrics.counters[entity]["rows_written"]
+                self.created[entity] = self.created.get(entity, 0) + count
+                print(
+                    "{} created: {}, written to {} of {} target(s)".format(
+                        entity, count, sum(t.error is None for t in live), len(targets)
+                    )
+                )
+                self.metrics.record_rss(entity)
+            live = [t for t in targets if t.error is None]
+            if self.scoped_plugins and live:
+                with self.metrics.phase("plugins", "generate"):
+                    await asyncio.gather(*map(self.target_scoped_plugins, live))
+                # like the rows copied, a row is counted once however many
+                # targets it is written to
+                count = max(t.rows.get("scoped_plugins", 0) for t in live)
+                self.metrics.add("plugins", "rows_written", count)
+                self.created["plugins"] = self.created.get("plugins", 0) + count
+                print(
+                    "scoped plugins created: {}, written to {} of {} target(s)".format(
+                        count, sum(t.error is None for t in live), len(targets)
+                    )
+                )
+        finally:
+            for target in targets:
+                if target.conn is not None:
+                    await target.conn.close()
 
-    def name_gen(self, quantity: int, entity: str) -> List[List[str]]:
-        data = []
-        for e in range(quantity):
-            data.append([str(uuid.uuid4()), "{}-{}-{}".format(self.prefix, entity, e)])
-        return data
+    async def target_scoped_plugins(self, target: Target) -> None:
+        """run the scoped plugin statements on one target, in one transaction"""
+        start = time.perf_counter()
+        count = 0
+        try:
+            async with target.conn.transaction(), target.conn.cursor() as cursor:
+                for _, statement, params in self.scoped_plugin_statements():
+                    await cursor.execute(statement, params)
+                    count += cursor.rowcount
+        except Exception as exc:
+            target.fail("scoped_plugins", exc)
+            return
+        target.rows["scoped_plugins"] = count
+        target.seconds["scoped_plugins"] = time.perf_counter() - start
 
-    def gen_workspaces(self, quantity) -> List[List[str]]:
-        return self.name_gen(quantity, "workspace")
+    def create_entities_fan_out(self) -> None:
+        """
+        Create the entities in the run's database and every other target at
+        the same time. Each row is generated once and sent to the targets
+        that lack it, each target over its own COPY stream. A target that
+        fails is reported and dropped, the others carry on.
+        """
+        targets = [Target(c) for c in [self.session.conninfo] + self.targets]
+        asyncio.run(self.fan_out_async(targets))
+        for target in targets:
+            for line in target.summary():
+                print(line)
+        self.failed_targets = [t for t in targets if t.error is not None]
 
-    def get_active_entity_ids(self, entity) -> List[str]:
-        active: Dict[str, Any] = self.get_active_entities_data(entity)
-        if entity == "workspaces":
-            ret: List[str] = [v["id"] for v in active.values()]
-        else:
-            ret: List[str] = [k for k in active.keys()]
-        return ret
+    ################ Resumable functions ##########################
 
-    def get_active_workspace_ids(self) -> List[str]:
-        entity = "workspaces"
-        active: Dict[str, Any] = self.get_active_entities_data(entity)
-        ret: List[str] = [v["id"] for v in active.values()]
-        return ret
+    def journal_config(self) -> Dict[str, Any]:
+        """
+        What identifies the entities a run creates, kept in its journal: the
+        prefix, to tell journals apart when reading them, and a hash of the
+        whole config file, with its plugin configs and scopes, together with
+        the options that change the rows generated from it
+        """
+        generation = {
+            "config": self.data,
+            "route_prefix": self.route_prefix,
+            "route_trailing_slash": self.route_trailing_slash,
+            "route_regex_path": self.route_regex_path,
+            "deterministic_ids": self.deterministic_ids,
+        }
+        normalized = json.dumps(generation, sort_keys=True, default=str)
+        return {
+            "prefix": self.prefix,
+            "sha256": hashlib.sha256(normalized.encode()).hexdigest(),
+        }
 
-    def string_rep(self, line: str, find: str = "%", replace: str = ",") -> str:
-        return re.sub(find, replace, line)
+    def workspace_existing(self, entity: str, ws_id: str) -> EntityStore:
+        """the entities of this type in one workspace"""
+        return self.get_entities(self.get_items[entity], entity, {ws_id})
 
-    ################# Create functions ###########################
+    def create_workspace_entity(
+        self,
+        entity: str,
+        ws_name: str,
+        ws_id: str,
+        services: Dict[str, Dict[str, str]],
+    ) -> int:
+        """
+        Create the entities of this type one workspace is missing, in
+        transactions of commit_every rows, returning how many were created.
+        services holds the ids and names of each workspace's services, read
+        from the database when an earlier run created them.
+        """
+        parents: Dict[str, str] = {}
+        if entity in ("routes", "plugins"):
+            parents = services.get(ws_id) or {
+                r.id: r.name
+                for r in self.workspace_existing("services", ws_id).records()
+            }
+        loaded: Optional[Dict[str, str]] = {} if entity == "services" else None
+        rows = self.hydrate_rows(
+            entity,
+            self.workspace_missing(
+                entity,
+                ws_name,
+                ws_id,
+                parents,
+                loaded,
+                self.workspace_existing(entity, ws_id),
+            ),
+        )
+        count = 0
+        while True:
+            chunk = islice(rows, self.commit_every) if self.commit_every else rows
+            with self.session.stage(entity):
+                written = self.copy_rows(entity, self.insert_items[entity], chunk)
+            count += written
+            if not self.commit_every or written < self.commit_every:
+                break
+        if loaded is not None:
+            services[ws_id] = loaded
+        return count
+
+    def create_entities_journaled(self) -> None:
+        """
+        Create the entity types one after another and each of them workspace
+        by workspace, committing every commit_every rows and recording every
+        finished workspace in the journal. An interruption loses at most the
+        chunk being written, and with resume the workspaces the journal
+        records are skipped without being read or diffed again.
+        """
+        self.journal.open(self.journal_config(), self.resume)
+        try:
+            with self.session.run():
+                names: List[str] = self.required_workspace_names
+                if not all(self.journal.is_done("workspaces", n) for n in names):
+                    with self.session.stage("workspaces"):
+                        self.create_entity("workspaces")
+                    for name in names:
+                        self.journal.record("workspaces", name)
+                workspaces: List[Tuple[str, str]] = self.active_workspaces()
+                services: Dict[str, Dict[str, str]] = {}
+                for entity in self.entites[1:]:
+                    count = skipped = 0
+                    for ws_name, ws_id in workspaces:
+                        if self.journal.is_done(entity, ws_name):
+                            skipped += 1
+                            continue
+                        count += self.create_workspace_entity(
+                            entity, ws_name, ws_id, services
+                        )
+                        self.journal.record(entity, ws_name)
+                    self.created[entity] = self.created.get(entity, 0) + count
+                    print(
+                        "{} created: {}".format(entity, count)
+                        + (
+                            " ({} workspace(s) done before)".format(skipped)
+                            if skipped
+                            else ""
+                        )
+                        + " " * 20
+                    )
+                    self.metrics.record_rss(entity)
+                    if self.memory_report:
+                        self.report_memory(entity)
+                if self.scoped_plugins:
+                    self.create_scoped_plugins()
+                if self.bulk_load:
+                    self.analyze_tables(self.entites)
+        finally:
+            self.journal.close()
 
-    def get_active_entities_data(self, entity: str) -> Dict[str, Any]:
-        current: Dict[str, Any] = self.db_cache[entity]
-        if not current:
-            current: Dict[str, Any] = self.get_entities(self.get_items[entity], entity)
-            self.db_cache[entity] = current
+    ################ Export and import functions ##################
 
-        active_workspaces: Dict[str, Any] = self.db_cache["workspaces"]
-        if not active_workspaces:
-            active_workspaces: Dict[str, Any] = self.get_entities(
-                self.get_items["workspaces"], "workspaces"
+    def table_columns(self, table: str) -> List[str]:
+        """every column of table, in the order the table defines them"""
+        with self.session.cursor() as cursor:
+            cursor.execute(
+                """\
+                SELECT attname FROM pg_attribute
+                WHERE attrelid = %s::regclass AND attnum > 0
+                AND NOT attisdropped ORDER BY attnum;""",
+                (table,),
             )
-            self.db_cache["workspaces"] = active_workspaces
-        required_workspace_names: List[str] = self.required_workspace_names
-        if entity == "workspaces":
-            active: List[str] = required_workspace_names
-        else:
-            active: List[str] = [
-                v["id"]
-                for v in active_workspaces.values()
-                if v["name"] in required_workspace_names
-            ]
+            return [row[0] for row in cursor.fetchall()]
 
-        return self.get_entity_data[entity](current, active, entity)
-
-    def get_active_entity_composit_names(
-        self, entity: str, key: str = "composit"
-    ) -> List[str]:
-        comp: List[str] = self.composit_cache[entity]
-        if not comp:
-            data: Dict[str, Any] = self.parse_cache[entity]
-            if not data:
-                data: Dict[str, Any] = self.get_active_entities_data(entity)
-                self.parse_cache[entity] = data
-            comp: List[str] = [v[key] for v in data.values()]
-            self.composit_cache[entity] = comp
-        return comp
-
-    def entities_to_create(self, entity: str) -> List[List[str]]:
-        key: str = "composit"
-        active: List[str] = self.get_active_entity_composit_names(entity, key)
-        required: List[str] = self.require_strings[entity]()
-        ret = []
-        for v in required:
-            p = v.split("^")
-            name = v
-            if name in active:
-                continue
-            config = "CONFIG"
-            if p[0] in self.plugins.keys():
-                config = json.dumps(self.plugins[p[0]]["config"])
-            ret.append(
-                [
-                    self.string_rep(self.string_rep(d), "CONFIG", config)
-                    for d in self.entity_data_hydrate[entity](v).split(",")
+    def export_table(
+        self, archive: Archive, table: str, groups: List[List[str]]
+    ) -> Dict[str, Any]:
+        """
+        COPY the rows of table in each group of workspaces out to a file of
+        its own, returning the table's entry in the manifest
+        """
+        columns: List[str] = self.table_columns(table)
+        column: str = "id" if table == "workspaces" else "ws_id"
+        files: List[Dict[str, Any]] = []
+        for part, ws_ids in enumerate(groups):
+            name = archive.file_name(table, part)
+            size = 0
+            with self.metrics.phase(table, "read"), self.session.cursor() as cursor:
+                with archive.open(name, "w") as f:
+                    with cursor.copy(
+                        sql.SQL(
+                            "COPY (SELECT {} FROM {} WHERE {} = ANY({}::uuid[])) "
+                            "TO STDOUT{}"
+                        ).format(
+                            sql.SQL(", ").join(map(sql.Identifier, columns)),
+                            sql.Identifier(table),
+                            sql.Identifier(column),
+                            sql.Literal(ws_ids),
+                            sql.SQL(
+                                " (FORMAT BINARY)"
+                                if self.copy_format == "binary"
+                                else ""
+                            ),
+                        )
+                    ) as copy:
+                        for data in copy:
+                            f.write(data)
+                            size += len(data)
+                rows = cursor.rowcount
+            self.metrics.add(table, "rows_read", rows)
+            files.append({"name": name, "rows": rows, "bytes": size})
+        self.metrics.record_rss(table)
+        print("{} exported: {}".format(table, sum(f["rows"] for f in files)))
+        return {"table": table, "columns": columns, "files": files}
+
+    def export_tables(self) -> None:
+        """
+        Write the entities in the config's workspaces to COPY files in
+        export_dir and a manifest listing them. Every table is read in one
+        repeatable read transaction, so the files agree with each other, and
+        split into up to concurrency files by workspace, so an import can
+        load them in parallel.
+        """
+        os.makedirs(self.export_dir, exist_ok=True)
+        archive = Archive(self.export_dir, self.compression)
+        try:
+            conn = self.session.connection()
+            with conn.transaction():
+                conn.execute(
+                    "SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY;"
+                )
+                ws_ids: List[str] = sorted(self.get_active_filter("services"))
+                groups: List[List[str]] = [
+                    ws_ids[i :: self.concurrency]
+                    for i in range(min(self.concurrency, len(ws_ids)))
                 ]
-            )
-        return ret
-
-    def workspaces_to_create(self) -> List[List[str]]:
-        key: str = "name"
-        entity: str = "workspaces"
-        active: List[str] = self.get_active_entity_composit_names(entity, key)
-        required: List[str] = self.require_strings[entity]()
-        ret = []
-        for v in required:
-            p = v.split("^")
-            name = p[1]
-            if name in active:
-                continue
-            ret.append(
-                [
-                    self.string_rep(d)
-                    for d in self.entity_data_hydrate[entity](v).split(",")
+                tables: List[Dict[str, Any]] = [
+                    self.export_table(
+                        archive, table, [ws_ids] if table == "workspaces" else groups
+                    )
+                    for table in self.entites
                 ]
+            archive.write_manifest(
+                {
+                    "format": self.copy_format,
+                    "prefix": self.prefix,
+                    "workspaces": len(ws_ids),
+                    "tables": tables,
+                }
             )
-        return ret
-
-    def create_entity(self, entity: str) -> None:
-        if entity == "workspaces":
-            entities_needed: List[List[str]] = self.workspaces_to_create()
-        else:
-            entities_needed: List[List[str]] = self.entities_to_create(entity)
-        self.insert_into_table(entity, self.insert_items[entity], entities_needed)
-
-    ################ Delete functions ##############################
-
-    def delete_entity(self, entity: str) -> None:
-        if entity == "workspaces":
-            delete: List[str] = self.get_active_workspace_ids()
-        else:
-            delete: List[str] = self.get_active_entity_ids(entity)
-        self.delete_from_table(entity, delete)
+        finally:
+            self.session.close()
+            self.report_metrics()
 
-    ################ SQL function ################################
-
-    def get_entities(self, items: List[str], table: str) -> Dict[str, Any]:
-        data = {}
-        with psycopg.connect(self.db_connect(self.db_params)) as conn:
-            with conn.cursor() as cursor:
-                with cursor.copy(
-                    "COPY (SELECT {} FROM {}) TO STDOUT".format(
-                        self.items_str(items), table
-                    )
-                ) as copy:
-                    for row in copy.rows():
-                        data[row[0]] = dict(zip(items, row))
-        return data
+    async def import_file_async(
+        self,
+        archive: Archive,
+        table: str,
+        columns: List[str],
+        file: Dict[str, Any],
+        parents: List["asyncio.Future[None]"],
+        connections: "asyncio.Queue[psycopg.AsyncConnection]",
+    ) -> None:
+        """
+        Wait for the files of the tables this one depends on, then COPY one
+        file into table over the first free connection, in one transaction.
+        The file is read (and decompressed) in a thread so files load in
+        parallel.
+        """
+        await asyncio.gather(*parents)
+        loop = asyncio.get_running_loop()
+        conn: psycopg.AsyncConnection = await connections.get()
+        try:
+            start = time.perf_counter()
+            with archive.open(file["name"], "r") as f:
+                async with conn.transaction():
+                    async with conn.cursor() as cursor:
+                        async with cursor.copy(self.copy_sql(table, columns)) as copy:
+                            while True:
+                                data = await loop.run_in_executor(
+                                    None, f.read, self.IMPORT_READ_SIZE
+                                )
+                                if not data:
+                                    break
+                                await copy.write(data)
+                                self.metrics.add(table, "bytes_sent", len(data))
+            self.metrics.add_time(table, "copy", time.perf_counter() - start)
+        finally:
+            connections.put_nowait(conn)
+        self.metrics.add(table, "rows_written", file["rows"])
+        self.created[table] = self.created.get(table, 0) + file["rows"]
+        self.metrics.record_rss(table)
 
-    def insert_into_table(
-        self, table: str, items: List[str], data: List[List[str]]
+    async def import_files_async(
+        self, archive: Archive, tables: Dict[str, Dict[str, Any]]
     ) -> None:
-        print("{} to create: {}".format(table, len(data)))
-        with psycopg.connect(self.db_connect(self.db_params)) as conn:
-            with conn.cursor() as cursor:
-                with cursor.copy(
-                    "COPY {} ({}) FROM STDIN".format(table, self.items_str(items))
-                ) as copy:
-                    for record in data:
-                        copy.write_row(record)
-        self.db_cache[table] = self.get_entities(self.get_items[table], table)
-
-    def delete_from_table(
-        self, table: str, ids_to_delete: List[str], id_key: str = "id"
-    ):
-        print("{} to delete: {}".format(table, len(ids_to_delete)))
-        with psycopg.connect(self.db_connect(self.db_params)) as conn:
-            with conn.cursor() as cursor:
-                cursor.execute("CREATE TEMP TABLE to_delete (id uuid);")
-                with cursor.copy("COPY to_delete (id) FROM STDIN;") as copy:
-                    for id_ in ids_to_delete:
-                        copy.write_row((id_,))
-                cursor.execute(
-                    """\
-                    DELETE FROM {} WHERE
-                       {} IN (SELECT id FROM to_delete);""".format(
-                        table, id_key
+        """
+        Schedule a COPY per file of the export, the files of a table
+        starting once every file of the tables it references (REFERENCES)
+        is loaded
+        """
+        connections: "asyncio.Queue[psycopg.AsyncConnection]" = asyncio.Queue()
+        conns: List[psycopg.AsyncConnection] = []
+        tasks: Dict[str, List["asyncio.Future[None]"]] = {}
+        try:
+            for _ in range(self.concurrency):
+                conn = await self.connect_async()
+                conns.append(conn)
+                connections.put_nowait(conn)
+            for table in self.entites:
+                if table not in tables:
+                    continue
+                parents = [t for d in self.REFERENCES[table] for t in tasks.get(d, [])]
+                tasks[table] = [
+                    asyncio.ensure_future(
+                        self.import_file_async(
+                            archive,
+                            table,
+                            tables[table]["columns"],
+                            file,
+                            parents,
+                            connections,
+                        )
                     )
-                )
-        self.db_cache[table] = self.get_entities(self.get_items[table], table)
+                    for file in tables[table]["files"]
+                ]
+            await asyncio.gather(*(t for files in tasks.values() for t in files))
+        finally:
+            for conn in conns:
+                await conn.close()
+
+    def import_tables(self) -> None:
+        """
+        Load an export from import_dir with COPY, in the format it was
+        written in, without generating or diffing anything, then ANALYZE the
+        tables. The rows must not exist yet.
+        """
+        archive = Archive(self.import_dir)
+        manifest: Dict[str, Any] = archive.read_manifest()
+        self.copy_format = manifest["format"]
+        tables: Dict[str, Dict[str, Any]] = {t["table"]: t for t in manifest["tables"]}
+        indexes: Dict[str, List[str]] = {}
+        start = time.perf_counter()
+        try:
+            if self.rebuild_indexes:
+                with self.session.run():
+                    with self.session.stage("drop_indexes"):
+                        for table in tables:
+                            indexes[table] = self.drop_indexes(table)
+            try:
+                asyncio.run(self.import_files_async(archive, tables))
+            finally:
+                with self.session.run():
+                    with self.session.stage("create_indexes"):
+                        for table, definitions in indexes.items():
+                            self.create_indexes(table, definitions)
+                    self.analyze_tables(list(tables))
+        finally:
+            self.report_metrics()
+        for table in tables:
+            print("{} imported: {}".format(table, self.created.get(table, 0)))
+        elapsed = time.perf_counter() - start
+        rows = sum(self.created.values())
+        print(
+            "imported {} rows in {:.2f}s ({:.0f} rows/sec)".format(
+                rows, elapsed, rows / elapsed
+            )
+        )
 
     ################ entry functions ##############################
 
     def create_entities(self) -> None:
-        for entity in self.entites:
-            self.create_entity(entity)
+        start = time.perf_counter()
+        try:
+            if self.targets:
+                self.create_entities_fan_out()
+            elif self.workers > 1:
+                self.create_entities_parallel()
+            elif self.engine == "async":
+                self.create_entities_async()
+            elif self.commit_every or self.resume:
+                self.create_entities_journaled()
+            else:
+                with self.session.run():
+                    for entity in self.entites:
+                        # batches commit on their own, outside of any stage
+                        stage = (
+                            nullcontext()
+                            if self.batching
+                            else self.session.stage(entity)
+                        )
+                        with stage:
+                            self.create_entity(entity)
+                    if self.scoped_plugins:
+                        self.create_scoped_plugins()
+                    if self.bulk_load and self.partition is None:
+                        self.analyze_tables(self.entites)
+        finally:
+            if self.partition is None:
+                self.report_metrics()
+        if self.partition is None:
+            elapsed = time.perf_counter() - start
+            rows = sum(self.created.values())
+            print(
+                "{} worker(s) created {} rows in {:.2f}s ({:.0f} rows/sec)".format(
+                    self.workers, rows, elapsed, rows / elapsed
+                )
+            )
+
+    def report_metrics(self) -> None:
+        """print where the time went and write the metrics file, if asked for"""
+        self.metrics.finish()
+        for line in self.metrics.summary():
+            print(line)
+        if self.metrics_file:
+            self.metrics.write(self.metrics_file, self.metrics_format)
+
+    def create_entities_parallel(self) -> None:
+        """
+        Create the workspaces, then split them between self.workers processes
+        that each create the services, routes, consumers and plugins of their
+        share over their own connection
+        """
+        indexes: Dict[str, List[str]] = {}
+        with self.session.run():
+            with self.session.stage("workspaces"):
+                self.create_entity("workspaces")
+            if self.rebuild_indexes:
+                with self.session.stage("drop_indexes"):
+                    for entity in self.entites[1:]:
+                        indexes[entity] = self.drop_indexes(entity)
+        workspaces = len(self.required_workspaces)
+        partitions = [
+            list(range(i, workspaces, self.workers))
+            for i in range(min(self.workers, workspaces))
+        ]
+        try:
+            with ProcessPoolExecutor(len(partitions)) as pool:
+                for created, metrics in pool.map(
+                    create_partition, repeat(self.options), partitions
+                ):
+                    for table, count in created.items():
+                        self.created[table] = self.created.get(table, 0) + count
+                    self.metrics.merge(metrics)
+        finally:
+            with self.session.run():
+                with self.session.stage("create_indexes"):
+                    for entity, definitions in indexes.items():
+                        self.create_indexes(entity, definitions)
+                if self.bulk_load:
+                    self.analyze_tables(self.entites)
+
+    def create_entities_async(self) -> None:
+        """
+        Create the workspaces, read what already exists, then load the other
+        entity types of every workspace concurrently over self.concurrency
+        connections, so the run takes as long as its longest chain of
+        dependent loads rather than the sum of them
+        """
+        indexes: Dict[str, List[str]] = {}
+        with self.session.run():
+            with self.session.stage("workspaces"):
+                self.create_entity("workspaces")
+            workspaces: List[Tuple[str, str]] = self.active_workspaces()
+            for entity in self.entites[1:]:
+                self.get_active_entities_data(entity)
+                self.get_column_types(entity, self.insert_items[entity])
+                if self.rebuild_indexes:
+                    indexes[entity] = self.drop_indexes(entity)
+        try:
+            asyncio.run(self.load_workspaces_async(workspaces))
+            if self.scoped_plugins:
+                with self.session.run():
+                    self.create_scoped_plugins()
+        finally:
+            with self.session.run():
+                with self.session.stage("create_indexes"):
+                    for entity, definitions in indexes.items():
+                        self.create_indexes(entity, definitions)
+                if self.bulk_load:
+                    self.analyze_tables(self.entites)
+        for entity in self.entites[1:]:
+            print("{} created: {}".format(entity, self.created.get(entity, 0)))
+            self.metrics.record_rss(entity)
+        if self.memory_report:
+            self.report_memory("all entities")
 
     def delete_entities(self) -> None:
-        for entity in reversed(self.entites):
-            self.delete_entity(entity)
+        try:
+            with self.session.run():
+                ws_ids: List[str] = self.get_delete_workspace_ids()
+                for entity in reversed(self.entites):
+                    self.delete_entity(entity, ws_ids)
+        finally:
+            self.report_metrics()
+
+
+def create_partition(
+    options: Dict[str, Any], partition: List[int]
+) -> Tuple[Dict[str, int], Metrics]:
+    """Create the entities of one share of the workspaces, run in a worker"""
+    runner = Runner(**options, partition=partition)
+    return runner.created, runner.metrics
 
 
 if __name__ == "__main__":
@@ -685,6 +4047,19 @@ them if this flag is set",
         required=False,
         help="Dump out a JSON list of all route paths (for automated load test)",
     )
+    parser.add_argument(
+        "--route-dump-format",
+        choices=Runner.ROUTE_DUMP_FORMATS,
+        default="json",
+        help="write the route dump as a JSON array, NDJSON or CSV",
+    )
+    parser.add_argument(
+        "--route-dump-source",
+        choices=["config", "database"],
+        default="config",
+        help="build the dumped paths from the config, or read the paths of \
+the routes in the database once the run is done",
+    )
 
     parser.add_argument(
         "--route-prefix",
@@ -704,6 +4079,259 @@ them if this flag is set",
         help="trun the routes path into a regex path",
     )
 
+    parser.add_argument(
+        "--memory-report",
+        action="store_true",
+        help="print the peak resident set size after each entity type is created",
+    )
+
+    parser.add_argument(
+        "--transaction",
+        choices=Session.TRANSACTION_MODES,
+        default="entity",
+        help="commit each entity type on its own (entity), the whole run at \
+once (single) or the whole run with a savepoint per entity type (savepoint)",
+    )
+
+    parser.add_argument(
+        "--refresh-cache",
+        action="store_true",
+        help="re-read the workspaces and services from the database after \
+writing to them",
+    )
+
+    parser.add_argument(
+        "--workers",
+        metavar="N",
+        type=int,
+        default=1,
+        help="load services, routes, consumers and plugins with N processes, \
+splitting the workspaces between them",
+    )
+
+    parser.add_argument(
+        "--copy-format",
+        choices=["binary", "text"],
+        default="binary",
+        help="the COPY format rows are sent to the Kong database in",
+    )
+
+    parser.add_argument(
+        "--deterministic-ids",
+        action="store_true",
+        help="derive every id from the entity name (UUIDv5) so reruns and \
+deletes do not need to read the tables",
+    )
+
+    parser.add_argument(
+        "--bulk-load",
+        action="store_true",
+        help="COPY into unlogged staging tables, move the rows with one \
+INSERT ... SELECT per table and ANALYZE the tables at the end",
+    )
+
+    parser.add_argument(
+        "--rebuild-indexes",
+        action="store_true",
+        help="drop the indexes that do not back a constraint before loading \
+each table and recreate them afterwards",
+    )
+
+    parser.add_argument(
+        "--generate-in-db",
+        action="store_true",
+        help="build the rows inside Postgres with generate_series instead of \
+sending them over COPY",
+    )
+
+    parser.add_argument(
+        "--delete-prefix",
+        action="store_true",
+        help="delete the entities of every workspace named with the config's \
+prefix, however many workspaces the config asks for",
+    )
+
+    parser.add_argument(
+        "--delete-batch-size",
+        metavar="rows",
+        type=int,
+        default=10000,
+        help="the number of rows deleted per transaction",
+    )
+
+    parser.add_argument(
+        "--engine",
+        choices=["sync", "async"],
+        default="sync",
+        help="load the entity types one after another (sync) or concurrently \
+as soon as the entities they depend on exist (async)",
+    )
+
+    parser.add_argument(
+        "--concurrency",
+        metavar="N",
+        type=int,
+        default=4,
+        help="the number of connections the async engine loads over",
+    )
+
+    parser.add_argument(
+        "--metrics-file",
+        metavar="path",
+        help="write the time, rows, bytes and peak memory of each phase of \
+the run to this file",
+    )
+
+    parser.add_argument(
+        "--metrics-format",
+        choices=Metrics.FORMATS,
+        default="json",
+        help="the format of the metrics file, JSON or the Prometheus text format",
+    )
+
+    parser.add_argument(
+        "--export",
+        metavar="DIR",
+        help="write the entities in the config's workspaces to COPY files and \
+a manifest in DIR instead of creating them",
+    )
+
+    parser.add_argument(
+        "--import",
+        dest="import_dir",
+        metavar="DIR",
+        help="load the COPY files exported to DIR with parallel COPY instead \
+of generating the entities",
+    )
+
+    parser.add_argument(
+        "--compression",
+        choices=Archive.COMPRESSIONS,
+        default="none",
+        help="how exported files are compressed, zstd needs the zstandard \
+package",
+    )
+
+    parser.add_argument(
+        "--commit-every",
+        metavar="rows",
+        type=int,
+        default=0,
+        help="create the entities workspace by workspace, committing every \
+N rows and recording each finished workspace in the journal",
+    )
+
+    parser.add_argument(
+        "--journal",
+        metavar="path",
+        default="./import.journal",
+        help="the checkpoint journal kept with --commit-every and --resume",
+    )
+
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="carry on from the journal of an interrupted run, skipping the \
+workspaces it records as done",
+    )
+
+    parser.add_argument(
+        "--batch-size",
+        metavar="rows",
+        type=int,
+        default=0,
+        help="write each entity type in COPY batches of this many rows, each \
+committed on its own, instead of one COPY per entity type. With \
+--target-commit-ms this is the size of the first batch",
+    )
+
+    parser.add_argument(
+        "--target-commit-ms",
+        metavar="ms",
+        type=float,
+        default=0.0,
+        help="write in batches sized to take about this long each from the \
+first row to the commit, adjusted to the throughput measured as they go",
+    )
+
+    parser.add_argument(
+        "--batch-log",
+        metavar="path",
+        help="append a JSON line of stats for every batch to this file",
+    )
+
+    parser.add_argument(
+        "--target",
+        dest="targets",
+        action="append",
+        metavar="DSN",
+        help="another Kong database to create the same entities in, as a \
+libpq connection string or URI. Can be given more than once. Every row is \
+generated once and sent to each database at the same time, with ids derived \
+from names as with --deterministic-ids",
+    )
+
+    parser.add_argument(
+        "--verify",
+        action="store_true",
+        help="check with grouped counts that the database holds the entities \
+the config asks for, instead of creating them. Exits with 1 if it does not",
+    )
+
+    parser.add_argument(
+        "--update",
+        nargs="*",
+        choices=Runner.UPDATE_COLUMNS,
+        metavar="TABLE",
+        help="bring the services, routes and plugins that already exist in \
+the config's workspaces in line with the config file, changing only the \
+rows that differ, instead of creating any. Give tables to update only those",
+    )
+
+    parser.add_argument(
+        "--churn",
+        action="append",
+        choices=Runner.CHURN_TYPES,
+        help="update existing entities in place, in rate controlled batches, \
+instead of creating any. Can be given more than once to churn several kinds \
+of entity in turn",
+    )
+
+    parser.add_argument(
+        "--churn-percent",
+        metavar="percent",
+        type=float,
+        default=10.0,
+        help="the percentage of the entities in the config's workspaces that \
+are churned",
+    )
+
+    parser.add_argument(
+        "--churn-rate",
+        metavar="updates",
+        type=float,
+        default=0.0,
+        help="the updates per second to churn at, 0 (the default) for as fast \
+as possible",
+    )
+
+    parser.add_argument(
+        "--churn-batch-size",
+        metavar="rows",
+        type=int,
+        default=100,
+        help="the most rows updated per transaction when churning",
+    )
+
+    parser.add_argument(
+        "--churn-duration",
+        metavar="seconds",
+        type=float,
+        default=0.0,
+        help="how long to churn for, 0 (the default) to churn until \
+interrupted",
+    )
+
     args = parser.parse_args()
     params = {
         "hostname": args.hostname,
@@ -712,7 +4340,7 @@ them if this flag is set",
         "password": args.password,
     }
 
-    Runner(
+    runner = Runner(
         args.config_file,
         params,
         args.delete,
@@ -721,4 +4349,40 @@ them if this flag is set",
         args.route_prefix,
         args.route_trailing_slash,
         args.route_regex_path,
+        memory_report=args.memory_report,
+        transaction=args.transaction,
+        refresh=args.refresh_cache,
+        workers=args.workers,
+        copy_format=args.copy_format,
+        deterministic_ids=args.deterministic_ids,
+        bulk_load=args.bulk_load,
+        rebuild_indexes=args.rebuild_indexes,
+        generate_in_db=args.generate_in_db,
+        delete_prefix=args.delete_prefix,
+        delete_batch_size=args.delete_batch_size,
+        engine=args.engine,
+        concurrency=args.concurrency,
+        metrics_file=args.metrics_file,
+        metrics_format=args.metrics_format,
+        export_dir=args.export,
+        import_dir=args.import_dir,
+        compression=args.compression,
+        route_dump_format=args.route_dump_format,
+        route_dump_source=args.route_dump_source,
+        commit_every=args.commit_every,
+        journal_file=args.journal,
+        resume=args.resume,
+        churn=args.churn,
+        churn_percent=args.churn_percent,
+        churn_rate=args.churn_rate,
+        churn_batch_size=args.churn_batch_size,
+        churn_duration=args.churn_duration,
+        verify=args.verify,
+        update=args.update == [] or args.update,
+        targets=args.targets,
+        batch_size=args.batch_size,
+        target_commit_ms=args.target_commit_ms,
+        batch_log=args.batch_log,
     )
+    if runner.verified is False or runner.failed_targets:
+        sys.exit(1)
@@ -1,14 +1,25 @@
 import http from 'k6/http';
 import { randomIntBetween } from 'https://jslib.k6.io/k6-utils/1.1.0/index.js';
 import { SharedArray } from 'k6/data';
+import papaparse from 'https://jslib.k6.io/papaparse/5.1.1/index.js';
 
 // not using SharedArray here will mean that the code in the function call (that is what loads and
 // parses the json) will be executed per each VU which also means that there will be a complete copy
 // per each VU
 
+// the route dump can be a JSON array, NDJSON or CSV (--route-dump-format), picked by
+// DATA_FORMAT or else by the file extension
 const data = new SharedArray('data_file', function () {
   console.log("WILL OPEN: "+__ENV.DATA_FILE)
-  return JSON.parse(open(__ENV.DATA_FILE));
+  let format = __ENV.DATA_FORMAT || __ENV.DATA_FILE.split('.').pop()
+  let content = open(__ENV.DATA_FILE)
+  if (format === 'ndjson') {
+    return content.split('\n').filter(line => line).map(line => JSON.parse(line));
+  }
+  if (format === 'csv') {
+    return papaparse.parse(content, { header: true, skipEmptyLines: true }).data.map(row => row.path);
+  }
+  return JSON.parse(content);
 });
 
 export const options = {